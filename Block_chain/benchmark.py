@@ -0,0 +1,185 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+try:
+    import resource # peak memory of a process, not available on Windows
+except ImportError:
+    resource = None
+
+import simulator
+
+
+# Scenarios of the benchmark: every combination of the values is run with the same seed
+QUICK_MATRIX = {"no_of_peers": [10,30],"tmean": [0.01],"mining_time": [0.1],"zeta": [(0,0),(20,20)]}
+FULL_MATRIX = {"no_of_peers": [10,30,100],"tmean": [0.01,0.05],"mining_time": [0.05,0.5],"zeta": [(0,0),(20,20),(35,10)]}
+# Metrics of a run that must not change when only the speed of the simulator changes
+CHECKED_METRICS = ["tot_blks_in_chain","tot_mined_blks","blks_in_chain_adversary1","blks_in_chain_adversary2"]
+# Depths of the blockchains rendered in the analysis stage, the images of whole blockchains take minutes on long runs
+RENDER_LAST_DEPTHS = 20
+# Event types whose mean handler time is compared with the baseline
+PROFILED_EVENTS = ["RECIEVE_TXN","CREATE_TXN","RECIEVE_BLOCK","CREATE_BLOCK","SUCCESSFUL_MINING"]
+
+############################################################################################################
+
+def build_scenarios(matrix):
+    """
+    Function to build the list of scenarios of a matrix
+    Returns a list of dictionaries with the parameters and the name of each scenario
+    """
+    scenarios = []
+    for no_of_peers,tmean,mining_time,(zeta1,zeta2) in itertools.product(matrix["no_of_peers"],matrix["tmean"],matrix["mining_time"],matrix["zeta"]):
+        name = f"peers={no_of_peers} tmean={tmean*1000:g}ms mining={mining_time*1000:g}ms zeta={zeta1}/{zeta2}"
+        scenarios.append({"name": name,"no_of_peers": no_of_peers,"zeta1": zeta1,"zeta2": zeta2,"tmean": tmean,"mining_time": mining_time})
+    return scenarios
+
+def peak_memory():
+    """
+    Function to get the peak resident memory of the process in megabytes, None if it cannot be measured
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024 # bytes on macOS, kilobytes on Linux
+
+def run_scenario(scenario,iterations,seed,profile,render_last_depths=RENDER_LAST_DEPTHS):
+    """
+    Function to run one scenario in a fresh worker process and time its stages
+    The analysis stage writes the whole output folder (Analysis.txt, the blockchain images of the last
+    render_last_depths depths and the network graph) into a temporary directory
+    Returns a dictionary with the wall time of every stage (in seconds), the events per second of the main loop,
+    the peak memory, the checked metrics and, with profile, the mean handler time of the profiled events
+    """
+    simulator.render_trees = True
+    simulator.render_last_depths = render_last_depths
+    simulation = simulator.Simulation(scenario["no_of_peers"],scenario["zeta1"],scenario["zeta2"],scenario["tmean"],scenario["mining_time"],iterations,seed)
+    if profile:
+        profiler = simulation.profile()
+    stages = {}
+    start = perf_counter()
+    simulation.setup()
+    stages["network_build"] = perf_counter() - start
+    start = perf_counter()
+    events = simulation.step(iterations)
+    stages["main_loop"] = perf_counter() - start
+    start = perf_counter()
+    simulation.drain()
+    stages["drain"] = perf_counter() - start
+    directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as output,contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(output) # analysis() writes the output folder in the working directory
+        try:
+            start = perf_counter()
+            metrics = simulation.analyse(write_output=True)
+            stages["analysis"] = perf_counter() - start
+        finally:
+            os.chdir(directory)
+    result = {
+        "stages": stages,
+        "events": events,
+        "events_per_second": events / stages["main_loop"] if stages["main_loop"] else 0,
+        "peak_memory_mb": peak_memory(),
+        "metrics": {key: metrics[key] for key in CHECKED_METRICS},
+    }
+    if profile:
+        event_types = profiler.summary()["event_types"]
+        result["handler_times"] = {name: event_types[name]["mean_time"] for name in PROFILED_EVENTS if name in event_types}
+    return result
+
+def run_isolated(scenario,iterations,seed,profile,render_last_depths=RENDER_LAST_DEPTHS):
+    """
+    Function to run a scenario in its own process, so the module state and the peak memory start fresh
+    """
+    with ProcessPoolExecutor(max_workers=1,mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_scenario,scenario,iterations,seed,profile,render_last_depths).result()
+
+def run_benchmark(scenarios,iterations,seed,repeats,profile=False,render_last_depths=RENDER_LAST_DEPTHS):
+    """
+    Function to run every scenario repeats times
+    The stage times are the minimum over the repeats, which is the least disturbed by the rest of the machine
+    Returns a dictionary scenario name -> result of run_scenario
+    """
+    results = {}
+    for i,scenario in enumerate(scenarios,1):
+        runs = [run_isolated(scenario,iterations,seed,False,render_last_depths) for _ in range(repeats)]
+        result = runs[0]
+        for stage in result["stages"]:
+            result["stages"][stage] = min(run["stages"][stage] for run in runs)
+        result["events_per_second"] = result["events"] / result["stages"]["main_loop"] if result["stages"]["main_loop"] else 0
+        if profile:
+            # the profiler slows the handlers down, so it runs separately from the timed runs
+            result["handler_times"] = run_isolated(scenario,iterations,seed,True,render_last_depths)["handler_times"]
+        results[scenario["name"]] = result
+        print(f"[{i}/{len(scenarios)}] {scenario['name']}: {format_result(result)}")
+    return results
+
+def format_result(result):
+    """
+    Function to format the timings of a scenario on one line
+    """
+    stages = ", ".join(f"{stage} {value:.3f}s" for stage,value in result["stages"].items())
+    memory = f", peak memory {result['peak_memory_mb']:.0f} MB" if result["peak_memory_mb"] is not None else ""
+    return f"{result['events_per_second']:.0f} events/s, {stages}{memory}"
+
+def compare(results,baseline,tolerance,min_time=0.05):
+    """
+    Function to compare the results with a baseline
+    A stage or handler that is more than tolerance (a fraction) slower than in the baseline is a regression,
+    and different checked metrics mean that the simulation does not do the same thing anymore
+    The stages shorter than min_time seconds in the baseline are not compared, their timings are mostly noise
+    Returns a list of the regressions and changes found
+    """
+    problems = []
+    for name,result in results.items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]
+        if base["events"] != result["events"] or base["metrics"] != result["metrics"]:
+            problems.append(f"{name}: the results changed, {base['metrics']} ({base['events']} events) in the baseline and {result['metrics']} ({result['events']} events) now")
+        timings = [(stage,base["stages"][stage],result["stages"][stage]) for stage in result["stages"] if base["stages"].get(stage,0) >= min_time]
+        timings += [(f"{event} handler",base["handler_times"][event],time) for event,time in result.get("handler_times",{}).items() if event in base.get("handler_times",{})]
+        for what,before,after in timings:
+            if before > 0 and after > before * (1 + tolerance):
+                problems.append(f"{name}: {what} {after/before - 1:.0%} slower ({before:.6f}s -> {after:.6f}s)")
+    return problems
+
+############################################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the blockchain simulator on a fixed matrix of scenarios")
+    parser.add_argument("--full",action="store_true",help="run the full matrix instead of the quick one")
+    parser.add_argument("--iterations",type=int,default=100000,help="iterations of the main loop of every scenario")
+    parser.add_argument("--seed",type=int,default=1,help="seed of every scenario")
+    parser.add_argument("--repeats",type=int,default=3,help="runs of every scenario, the fastest is kept")
+    parser.add_argument("--profile",action="store_true",help="also measure the mean time of the event handlers, in an extra run")
+    parser.add_argument("--render-last-depths",type=int,default=RENDER_LAST_DEPTHS,help="depths of the blockchains rendered in the analysis stage")
+    parser.add_argument("--output",default="benchmark.json",help="JSON file to write the results to")
+    parser.add_argument("--baseline",default=None,help="JSON file of a previous benchmark to compare with")
+    parser.add_argument("--tolerance",type=float,default=0.1,help="fraction by which a stage may be slower than the baseline")
+    parser.add_argument("--min-time",type=float,default=0.05,help="stages shorter than this in the baseline (in seconds) are not compared")
+    args = parser.parse_args()
+
+    scenarios = build_scenarios(FULL_MATRIX if args.full else QUICK_MATRIX)
+    results = run_benchmark(scenarios,args.iterations,args.seed,args.repeats,args.profile,args.render_last_depths)
+    with open(args.output,'w') as f:
+        json.dump({"iterations": args.iterations,"seed": args.seed,"render_last_depths": args.render_last_depths,"results": results},f,indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["iterations"] != args.iterations or baseline["seed"] != args.seed or baseline.get("render_last_depths") != args.render_last_depths:
+            sys.exit(f"The baseline was run with {baseline['iterations']} iterations, seed {baseline['seed']} and {baseline.get('render_last_depths')} rendered depths, not {args.iterations}, {args.seed} and {args.render_last_depths}")
+        problems = compare(results,baseline,args.tolerance,args.min_time)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print(f"No regressions compared with {args.baseline}")
@@ -0,0 +1,574 @@
+import argparse
+import math
+import multiprocessing
+import os
+import traceback
+from collections import deque
+
+from tqdm import tqdm
+
+import simulator
+from simulator import Block, Event, Transaction
+
+
+# Events that are processed by their reciever, all the other events are processed by their sender
+RECIEVER_EVENTS = {
+    simulator.RECIEVE_TXN,simulator.RECIEVE_BLOCK,simulator.RECIEVE_INV,simulator.RECIEVE_GETDATA,
+    simulator.RECIEVE_CMPCT_BLOCK,simulator.RECIEVE_GETBLOCKTXN,
+}
+
+############################################################################################################
+# Partitioning
+
+def partition_peers(topology,no_of_partitions):
+    """
+    Function to split the peers into partitions of nearly equal size
+    The peers are taken in breadth first order from peer 0, so neighbours tend to be in the same partition
+    and fewer events cross partitions
+    Returns a list with the partition of every peer
+    """
+    order = []
+    visited = [False]*topology.no_of_peers
+    for start in range(topology.no_of_peers):
+        if visited[start]:
+            continue
+        visited[start] = True
+        q = deque([start])
+        while q:
+            v = q.popleft()
+            order.append(v)
+            for i in topology.neighbours[v]:
+                if not visited[i]:
+                    visited[i] = True
+                    q.append(i)
+    partition = [0]*topology.no_of_peers
+    for position,peer_id in enumerate(order):
+        partition[peer_id] = position * no_of_partitions // len(order)
+    return partition
+
+def lookahead(topology,partition):
+    """
+    Function to get the lookahead of a partitioning: the smallest propagation delay of a link between two partitions
+    Every event sent to another partition is scheduled at least this long after the event that sent it
+    With a single partition the smallest propagation delay of any link is used, so the windows stay short
+    """
+    delay = math.inf
+    any_delay = math.inf
+    for i in range(topology.no_of_peers):
+        for j in topology.neighbours[i]:
+            link_delay = min(topology.links.propagation_delay(i,j),topology.links.propagation_delay(j,i))
+            any_delay = min(any_delay,link_delay)
+            if partition[i] != partition[j]:
+                delay = min(delay,link_delay)
+    return delay if delay != math.inf else any_delay
+
+def event_owner(event):
+    """
+    Function to get the id of the peer that processes an event
+    """
+    return event.reciever_id if event.type in RECIEVER_EVENTS else event.sender_id
+
+############################################################################################################
+# Worker side
+
+class BlockRegistry:
+
+    """
+    BlockRegistry class to represent the blocks that a partition has sent to or recieved from other partitions
+    Blocks cross partitions as a header, their transactions and the balances they changed. Each partition
+    rebuilds a block once and shares it between its peers, like the peers of the serial simulator share blocks
+    """
+
+    def __init__(self,genesis):
+        """
+        Constructor to initialize the registry
+        Args:
+        genesis: genesis block of one of the peers of the partition
+        """
+        self.blocks = {genesis.block_id: genesis} # block id -> block
+        self.pending = {} # block id -> [(child block, balance changes)] for children whose balances wait for the block
+        self.pending_changes = {} # block id -> balance changes of the imported blocks whose balances wait for their parent
+
+    def export_block(self,block):
+        """
+        Function to get the wire form of a block of this partition
+        """
+        if block.block_id not in self.blocks:
+            self.blocks[block.block_id] = block
+            self.resolve(self.pending.pop(block.block_id,[]))
+        if block.peer_balances is not None:
+            changes = block.peer_balances.changes
+        else:
+            changes = self.pending_changes[block.block_id] # an orphan relayed or requested before its parent arrived
+        return (block.block_id,block.prev_block_id,block.creator_id,block.time,block.transactions_list,block.block_size,changes)
+
+    def import_block(self,wire):
+        """
+        Function to get the block of this partition for the wire form of a block
+        """
+        block = self.blocks.get(wire[0])
+        if block is not None:
+            return block
+        block = Block.__new__(Block) # the block already has an id, so the constructor is not called
+        block.block_id,block.prev_block_id,block.creator_id,block.time,block.transactions_list,block.block_size,changes = wire
+        block.parent = None
+        block.children = []
+        block.depth = 0
+        block.peer_balances = None
+        block.skip = None
+        self.blocks[block.block_id] = block
+        parent = self.blocks.get(block.prev_block_id)
+        if parent is None or parent.peer_balances is None:
+            # a peer adds a block only after its parent, so the balances are ready before the peer reads them,
+            # but the block can be sent on before that, so its changes are kept for export_block
+            self.pending.setdefault(block.prev_block_id,[]).append((block,changes))
+            self.pending_changes[block.block_id] = changes
+        else:
+            self.resolve([(block,changes)])
+        return block
+
+    def resolve(self,waiting):
+        """
+        Function to compute the balances of blocks whose parent balances are known, and then of their waiting children
+        """
+        while waiting:
+            block,changes = waiting.pop()
+            block.peer_balances = self.blocks[block.prev_block_id].peer_balances.apply(changes)
+            self.pending_changes.pop(block.block_id,None)
+            waiting.extend(self.pending.pop(block.block_id,[]))
+
+
+class PartitionEvents:
+
+    """
+    PartitionEvents class to represent the event queue of one partition
+    Events of the peers of the partition go to the simulator event queue, and events of the other peers
+    go to an outbox that is sent to their partitions at the end of the window.
+    get_event only returns the events before the end of the current window
+    """
+
+    def __init__(self,queue,partition,index,registry):
+        """
+        Constructor to initialize the event queue
+        Args:
+        queue: event queue of the simulator
+        partition: partition of every peer
+        index: index of this partition
+        registry: block registry of this partition
+        """
+        self.queue = queue
+        self.partition = partition
+        self.index = index
+        self.registry = registry
+        self.outbox = {} # partition -> list of events in wire form
+        self.wire_transactions = {} # transaction id -> wire form of the transactions sent in this window
+        self.held = None # first event after the end of the window
+        self.window_end = -math.inf
+
+    def add_event(self,event):
+        destination = self.partition[event_owner(event)]
+        if destination == self.index:
+            self.queue.add_event(event)
+            return
+        item = event.item
+        if isinstance(item,Transaction):
+            # a tuple is several times faster to send than the transaction object
+            wire = self.wire_transactions.get(item.transaction_id)
+            if wire is None:
+                wire = self.wire_transactions[item.transaction_id] = item.__getstate__()
+            item = wire
+        elif isinstance(item,Block):
+            item = self.registry.export_block(item)
+        self.outbox.setdefault(destination,[]).append((event.scheduled_time,event.sender_id,event.reciever_id,item,event.type,event.misc))
+
+    def add_wire_events(self,wire_events):
+        """
+        Function to add the events sent by the other partitions
+        A transaction sent to several peers of the partition is rebuilt once
+        """
+        transactions = {} # transaction id -> transaction
+        for scheduled_time,sender_id,reciever_id,item,type,misc in wire_events:
+            if isinstance(item,tuple):
+                if len(item) == 5: # sender, reciever, amount, transaction id, time
+                    txn = transactions.get(item[3])
+                    if txn is None:
+                        txn = transactions[item[3]] = Transaction.__new__(Transaction) # the transaction already has an id
+                        txn.__setstate__(item)
+                    item = txn
+                else:
+                    item = self.registry.import_block(item)
+            self.queue.add_event(Event(scheduled_time,sender_id,reciever_id,item,type,misc))
+
+    def start_window(self,window_end):
+        """
+        Function to start a window that ends at window_end
+        """
+        if self.held is not None:
+            self.queue.add_event(self.held)
+            self.held = None
+        self.window_end = window_end
+
+    def get_event(self):
+        event = self.queue.get_event()
+        if event is not None and event.scheduled_time >= self.window_end:
+            self.held = event # no event can be added before it until the window ends
+            return None
+        return event
+
+    def next_time(self):
+        """
+        Function to get the scheduled time of the next event of the partition
+        The events added since the held event was taken out (by the release of the selfish blocks) can be earlier
+        """
+        if self.held is not None:
+            self.queue.add_event(self.held)
+        self.held = self.queue.get_event()
+        return math.inf if self.held is None else self.held.scheduled_time
+
+    def take_outbox(self):
+        """
+        Function to take the events for the other partitions
+        """
+        outbox,self.outbox = self.outbox,{}
+        self.wire_transactions = {}
+        return outbox
+
+    def __len__(self):
+        return len(self.queue) + (self.held is not None)
+
+
+def worker(connection,index,partition,topology,parameters,settings,seed):
+    """
+    Function to run the simulation of one partition in a worker process
+    The worker builds the whole network (all the peers and links) and only processes the events of its own peers,
+    so the memory of every worker grows with the total number of peers and not with the size of its partition
+    The worker answers the commands of the coordinator sent on connection:
+    ("window", window end, events, draining), ("release",), ("metrics", analysed peer id) and ("stop",)
+    """
+    try:
+        for name,value in settings.items():
+            setattr(simulator,name,value)
+        no_of_partitions = max(partition) + 1
+        simulator.id_stride = no_of_partitions
+        sim = simulator.Simulation(*parameters,max_iterations=math.inf,seed=None if seed is None else f"{seed}:{index}",topology=topology)
+        # every partition uses its own transaction and block ids: index + k * number of partitions
+        sim.state["transaction_id"] = index
+        sim.state["block_id"] = index
+        local_peer = partition.index(index)
+        sim.state["events"] = events = PartitionEvents(simulator.create_event_queue(),partition,index,None)
+        sim.setup()
+        events.take_outbox() # the initial events of the other peers are created by their own partitions
+        sim.activate() # this process only runs this simulation, so its state stays installed
+        events.registry = BlockRegistry(simulator.N.peers[local_peer].BlockChain.root)
+        connection.send(("ready",events.next_time()))
+
+        while True:
+            command = connection.recv()
+            if command[0] == "window":
+                _,window_end,wire_events,draining = command
+                events.add_wire_events(wire_events)
+                events.start_window(window_end)
+                processed = 0
+                while True:
+                    event = events.get_event()
+                    if event == None:
+                        break
+                    if not draining:
+                        simulator.current_time = event.scheduled_time # the simulated time stops at the end of the main loop
+                    simulator.process_event(event,draining)
+                    processed += 1
+                connection.send(("done",events.take_outbox(),events.next_time(),processed))
+            elif command[0] == "release":
+                # release all the selfish blocks at the end of the simulation
+                for adversary_id in (simulator.adversary1_id,simulator.adversary2_id):
+                    peer = simulator.N.peers[adversary_id]
+                    if partition[adversary_id] == index and len(peer.selfish_blocks) != 0:
+                        peer.release_all_selfish_blks(simulator.current_time)
+                connection.send(("done",events.take_outbox(),events.next_time(),0))
+            elif command[0] == "metrics":
+                connection.send(("metrics",partition_metrics(partition,index,command[1])))
+            elif command[0] == "stop":
+                break
+    except Exception:
+        connection.send(("error",traceback.format_exc()))
+    finally:
+        connection.close()
+
+def partition_metrics(partition,index,analysed_peer_id):
+    """
+    Function to get the counters of a partition that are merged into the metrics of the simulation
+    """
+    metrics = {
+        "tot_blks_adversary1": simulator.tot_blks_adversary1,
+        "tot_blks_adversary2": simulator.tot_blks_adversary2,
+        "tot_mined_blks": simulator.tot_mined_blks,
+        "payload_kbits_sent": simulator.payload_kbits_sent,
+        "inv_kbits_sent": simulator.inv_kbits_sent,
+        "simulated_time": simulator.current_time,
+    }
+    if partition[analysed_peer_id] == index:
+        # blocks of the adversaries in the longest chain of the analysed peer
+        blks_in_chain_adversary1 = 0
+        blks_in_chain_adversary2 = 0
+        chain = simulator.N.peers[analysed_peer_id].BlockChain
+        blk = chain.find_block(chain.longest_chain_id)
+        while blk.block_id != 0:
+            if blk.creator_id == simulator.adversary1_id:
+                blks_in_chain_adversary1 += 1
+            if blk.creator_id == simulator.adversary2_id:
+                blks_in_chain_adversary2 += 1
+            blk = blk.parent
+        metrics["blks_in_chain_adversary1"] = blks_in_chain_adversary1
+        metrics["blks_in_chain_adversary2"] = blks_in_chain_adversary2
+    if partition[0] == index:
+        metrics["tot_blks_in_chain"] = simulator.N.peers[0].BlockChain.max_depth
+    return metrics
+
+############################################################################################################
+# Coordinator side
+
+class Coordinator:
+
+    """
+    Coordinator class to represent the main process of a parallel simulation
+    The peers are split into partitions that are simulated by worker processes. The workers run in windows
+    of simulated time as long as the lookahead, from the time of the earliest pending event: an event sent to
+    another partition is scheduled at least one lookahead after the event that sent it, so it always falls
+    after the window and every worker can process its window without waiting for the others
+    """
+
+    def __init__(self,topology,partition,parameters,seed):
+        """
+        Constructor to start the workers
+        Args:
+        topology: topology of the network
+        partition: partition of every peer
+        parameters: number of peers, hashing powers, mean transaction time and mean mining time
+        seed: seed of the random number generators, None for random seeds
+        """
+        self.no_of_partitions = max(partition) + 1
+        self.lookahead = lookahead(topology,partition)
+        if self.lookahead <= 0:
+            raise ValueError("The parallel simulation needs a positive propagation delay on every link between partitions")
+        settings = {name: getattr(simulator,name) for name in simulator.SIMULATION_SETTINGS}
+        context = multiprocessing.get_context()
+        self.connections = []
+        self.workers = []
+        for index in range(self.no_of_partitions):
+            connection,worker_connection = context.Pipe()
+            process = context.Process(target=worker,args=(worker_connection,index,partition,topology,parameters,settings,seed),daemon=True)
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(process)
+        self.next_times = [self.recieve(i)[1] for i in range(self.no_of_partitions)]
+        self.inbox = [[] for _ in range(self.no_of_partitions)] # events to send to every partition
+        self.windows = 0 # number of windows run
+
+    def recieve(self,index):
+        """
+        Function to recieve the answer of a worker, and raise its error if it failed
+        """
+        answer = self.connections[index].recv()
+        if answer[0] == "error":
+            self.stop()
+            raise RuntimeError(f"Partition {index} failed:\n{answer[1]}")
+        return answer
+
+    def collect(self):
+        """
+        Function to collect the answers of all the workers and route the events between the partitions
+        Returns the number of events processed
+        """
+        processed = 0
+        for index in range(self.no_of_partitions):
+            _,outbox,self.next_times[index],n = self.recieve(index)
+            processed += n
+            for destination,wire_events in outbox.items():
+                self.inbox[destination].extend(wire_events)
+        return processed
+
+    def next_time(self):
+        """
+        Function to get the time of the earliest pending event, in a worker or on its way to one
+        """
+        times = list(self.next_times)
+        for wire_events in self.inbox:
+            if wire_events:
+                times.append(min(wire_event[0] for wire_event in wire_events))
+        return min(times)
+
+    def run_window(self,draining=False):
+        """
+        Function to run one window on all the workers
+        Returns the number of events processed, or None if there are no more events
+        """
+        start = self.next_time()
+        if start == math.inf:
+            return None
+        for index in range(self.no_of_partitions):
+            self.connections[index].send(("window",start + self.lookahead,self.inbox[index],draining))
+            self.inbox[index] = []
+        self.windows += 1
+        return self.collect()
+
+    def release(self):
+        """
+        Function to release the selfish blocks of the adversaries
+        """
+        for connection in self.connections:
+            connection.send(("release",))
+        self.collect()
+
+    def metrics(self,analysed_peer_id):
+        """
+        Function to collect the counters of all the partitions
+        """
+        for connection in self.connections:
+            connection.send(("metrics",analysed_peer_id))
+        return [self.recieve(index)[1] for index in range(self.no_of_partitions)]
+
+    def stop(self):
+        """
+        Function to stop the workers
+        """
+        for connection in self.connections:
+            try:
+                connection.send(("stop",))
+            except (BrokenPipeError,OSError):
+                pass
+        for process in self.workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+def merge_metrics(topology,parameters,max_iterations,partition_metrics_list):
+    """
+    Function to merge the counters of the partitions into the metrics computed by simulator.analysis()
+    """
+    no_of_peers,zeta1,zeta2,tmean,mining_time = parameters
+    merged = {}
+    for metrics in partition_metrics_list:
+        for key,value in metrics.items():
+            if key == "simulated_time":
+                merged[key] = max(merged.get(key,0),value)
+            else:
+                merged[key] = merged.get(key,0) + value
+    blks_in_chain_adversary1 = merged["blks_in_chain_adversary1"]
+    blks_in_chain_adversary2 = merged["blks_in_chain_adversary2"]
+    tot_blks_adversary1 = merged["tot_blks_adversary1"]
+    tot_blks_adversary2 = merged["tot_blks_adversary2"]
+    tot_blks_in_chain = merged["tot_blks_in_chain"]
+    tot_mined_blks = merged["tot_mined_blks"]
+    return {
+        "no_of_peers": no_of_peers,
+        "zeta1": zeta1,
+        "zeta2": zeta2,
+        "tmean": tmean,
+        "mining_time": mining_time,
+        "max_iterations": max_iterations,
+        "adversary1_id": topology.adversary1_id,
+        "adversary2_id": topology.adversary2_id,
+        "blks_in_chain_adversary1": blks_in_chain_adversary1,
+        "blks_in_chain_adversary2": blks_in_chain_adversary2,
+        "tot_blks_adversary1": tot_blks_adversary1,
+        "tot_blks_adversary2": tot_blks_adversary2,
+        "tot_blks_in_chain": tot_blks_in_chain,
+        "tot_mined_blks": tot_mined_blks,
+        "mpu_adversary1": blks_in_chain_adversary1/tot_blks_adversary1 if tot_blks_adversary1 != 0 else 0,
+        "mpu_adversary2": blks_in_chain_adversary2/tot_blks_adversary2 if tot_blks_adversary2 != 0 else 0,
+        "mpu_overall": tot_blks_in_chain/tot_mined_blks if tot_mined_blks != 0 else 0,
+        "fraction_adversary1": blks_in_chain_adversary1/tot_blks_in_chain if tot_blks_in_chain != 0 else 0,
+        "fraction_adversary2": blks_in_chain_adversary2/tot_blks_in_chain if tot_blks_in_chain != 0 else 0,
+        "payload_kbits_sent": merged["payload_kbits_sent"],
+        "inv_kbits_sent": merged["inv_kbits_sent"],
+        "simulated_time": merged["simulated_time"],
+    }
+
+def analysed_peer(topology):
+    """
+    Function to find the peer used for the analysis, like simulator.analysis():
+    the first peer that is not an adversary or a neighbour of an adversary
+    """
+    adversaries = (topology.adversary1_id,topology.adversary2_id)
+    for i in range(topology.no_of_peers):
+        if i not in adversaries and all(i not in topology.neighbours[j] for j in adversaries):
+            return i
+    return 0
+
+def run_parallel_simulation(peers,hashing_power1,hashing_power2,txn_mean_time,block_mean_time,iterations=2000000,seed=None,partitions=None,topology=None,show_progress=True):
+    """
+    Function to run a simulation on several processes
+    The results are statistically equivalent to simulator.run_simulation(), but not identical:
+    every partition has its own random number generator and the simulation stops at the end of the
+    window in which the total number of events reaches iterations
+    Args:
+    peers: number of peers in the network
+    hashing_power1: percentage hashing power of selfish miner1
+    hashing_power2: percentage hashing power of selfish miner2
+    txn_mean_time: mean time between transactions (in seconds)
+    block_mean_time: mean time between the blocks (in seconds)
+    iterations: number of events to process before the selfish blocks are released
+    seed: seed of the random number generators, None for random seeds
+    partitions: number of worker processes, the number of cores by default
+    topology: topology snapshot to use instead of generating a new network
+    show_progress: whether to show a progress bar
+    Returns the metrics of simulator.analysis(), with the seed, the number of partitions, the lookahead and the number of windows
+    """
+    if hashing_power1 < 0 or hashing_power2 < 0 or hashing_power1 + hashing_power2 > 100:
+        raise ValueError("The hashing powers of the selfish miners must be non-negative and add up to at most 100 percent")
+    if simulator.relay_mode == "fanout":
+        raise ValueError("The fanout relay mode delivers to peers of several partitions from one event, use the classic or fused relay mode")
+    if simulator.finality_depth is not None:
+        raise ValueError("The blocks cannot be pruned in a parallel simulation, every partition only sees the blockchains of its own peers, set finality_depth to None")
+    if topology is None:
+        topology = simulator.generate_topology(peers,seed)
+    partitions = min(partitions or os.cpu_count(),peers)
+    partition = partition_peers(topology,partitions)
+    parameters = (peers,hashing_power1,hashing_power2,txn_mean_time,block_mean_time)
+
+    coordinator = Coordinator(topology,partition,parameters,seed)
+    try:
+        progress = tqdm(total=iterations) if show_progress else None
+        processed = 0
+        while processed < iterations:
+            n = coordinator.run_window()
+            if n is None:
+                break # break if there are no more events
+            processed += n
+            if progress is not None:
+                progress.update(n)
+        if progress is not None:
+            progress.close()
+
+        # release the selfish blocks and deliver the remaining blocks, so all peers have the same blockchain
+        coordinator.release()
+        while coordinator.run_window(draining=True) is not None:
+            pass
+        metrics = merge_metrics(topology,parameters,iterations,coordinator.metrics(analysed_peer(topology)))
+    finally:
+        coordinator.stop()
+    metrics["seed"] = seed
+    metrics["partitions"] = coordinator.no_of_partitions
+    metrics["lookahead"] = coordinator.lookahead
+    metrics["windows"] = coordinator.windows
+    return metrics
+
+############################################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a blockchain simulation on several processes")
+    parser.add_argument("--peers",type=int,default=100,help="number of peers")
+    parser.add_argument("--zeta1",type=int,default=20,help="percentage hashing power of selfish miner1")
+    parser.add_argument("--zeta2",type=int,default=20,help="percentage hashing power of selfish miner2")
+    parser.add_argument("--tmean",type=float,default=10,help="mean time between transactions (in milliseconds)")
+    parser.add_argument("--mining-time",type=float,default=100,help="mean time between the blocks (in milliseconds)")
+    parser.add_argument("--max-iterations",type=int,default=2000000,help="number of events to simulate")
+    parser.add_argument("--partitions",type=int,default=os.cpu_count(),help="number of worker processes")
+    parser.add_argument("--seed",type=int,default=None,help="seed of the random number generators")
+    args = parser.parse_args()
+
+    metrics = run_parallel_simulation(args.peers,args.zeta1,args.zeta2,args.tmean/1000,args.mining_time/1000,args.max_iterations,args.seed,args.partitions)
+    for key,value in metrics.items():
+        print(f"{key}: {value}")
@@ -1,12 +1,29 @@
 import random
 import heapq
 import sys
+import math
 from anytree import Node
 from anytree.exporter import DotExporter
 import networkx as nx
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import os
+import pickle
+import gzip
+import struct
+import shutil
+import json
+import warnings
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, count
+from collections import OrderedDict, deque
+from array import array
+from bisect import bisect_left
+try:
+    import numpy as np # optional, RandomStreams draws its random numbers in batches with numpy if it is installed
+except ImportError:
+    np = None
 
 
 
@@ -15,14 +32,37 @@ no_of_peers = None
 current_time  = 0 # in seconds
 max_no_of_transactions = 998 # maximum number of transactions in a block (excluding coinbase txn)
 size_of_transaction = 8 # in Kilobits
+inv_message_size = 0.288 # in Kilobits, size of an inventory announcement or request (36 bytes)
+short_id_size = 0.048 # in Kilobits, size of a short transaction id in a compact block (6 bytes)
 transaction_id = 0 # unique id for each transaction
 block_id = 0 # unique id for each block
+id_stride = 1 # step between consecutive transaction and block ids, the parallel engine gives every partition its own ids
 mining_time = None # in seconds
 mining_fee = 50 # in units
 coinbase_id = -1 # id of the coinbase
 tmean = None # mean time between transactions
+zeta1 = 0 # percentage hashing power of selfish miner1
+zeta2 = 0 # percentage hashing power of selfish miner2
+max_iterations = 0 # maximum number of iterations of the main loop
+N = None # network of the running simulation
 adversary1_id = None # id of the first adversary
 adversary2_id = None  # id of the second adversary
+initial_balance = 100 # balance of every peer in the genesis block
+balance_checkpoint_interval = 32 # a full balance array is stored every this many blocks along a chain
+relay_mode = "fused" # how relayed items are scheduled: "classic" (forward event, then recieve event), "fused" (one recieve event per neighbour) or "fanout" (one event per relay delivering to the neighbours in turn)
+relay_protocol = "push" # how items are relayed: "push" (send the full item to the neighbours) or "inv" (announce the item and send it only to the neighbours that request it)
+compact_blocks = False # send blocks as a header with short transaction ids, rebuilt by the reciever from its mempool
+scheduler = "heap" # pending event queue: "heap" (binary heap) or "calendar" (calendar queue)
+max_mempool_size = 50000 # maximum number of unconfirmed transactions kept by a peer
+max_seen_transactions = 100000 # maximum number of transaction ids a peer remembers for de-duplication
+topology_builder = "dense" # how the network is generated: "dense" (random graphs until one is connected, delay and speed matrices) or "sparse" (connected with 3 to 6 neighbours by construction, per-link arrays)
+latency_model = "random" # propagation delays: "random" (drawn for every pair of peers and stored) or "coordinates" (computed from the positions of the peers, see CoordinateLinks)
+finality_depth = None # blocks this many blocks below the chain all the peers agree on are final: the stale branches forking off below them are pruned and they keep only their header, None to keep every block
+random_streams = False # draw the transactions, queuing delays and mining times from independent per-peer streams (RandomStreams) instead of the random module
+render_trees = True # whether analysis() renders the blockchain of every peer as an image
+render_peers = None # ids of the peers whose blockchain is rendered, None for all the peers
+render_last_depths = None # only render the blocks in the last this many depths of a blockchain, None for all the blocks
+render_workers = None # number of threads running Graphviz to render the images, None for the default of ThreadPoolExecutor
 
 queing_delay_constant = 96 # kbits
 fast_link_speed = 100*1000 # 100 Mbps in kbps   
@@ -36,6 +76,28 @@ CREATE_BLOCK = 4
 FORWARD_BLOCK = 5
 RECIEVE_BLOCK = 6
 SUCCESSFUL_MINING = 7
+FANOUT_TXN = 8
+FANOUT_BLOCK = 9
+RECIEVE_INV = 10
+RECIEVE_GETDATA = 11
+RECIEVE_CMPCT_BLOCK = 12
+RECIEVE_GETBLOCKTXN = 13
+
+# names of the event types, for the reports
+EVENT_NAMES = {
+    CREATE_TXN: "CREATE_TXN",FORWARD_TXN: "FORWARD_TXN",RECIEVE_TXN: "RECIEVE_TXN",CREATE_BLOCK: "CREATE_BLOCK",
+    FORWARD_BLOCK: "FORWARD_BLOCK",RECIEVE_BLOCK: "RECIEVE_BLOCK",SUCCESSFUL_MINING: "SUCCESSFUL_MINING",
+    FANOUT_TXN: "FANOUT_TXN",FANOUT_BLOCK: "FANOUT_BLOCK",RECIEVE_INV: "RECIEVE_INV",RECIEVE_GETDATA: "RECIEVE_GETDATA",
+    RECIEVE_CMPCT_BLOCK: "RECIEVE_CMPCT_BLOCK",RECIEVE_GETBLOCKTXN: "RECIEVE_GETBLOCKTXN",
+}
+
+# kinds of trace records
+TRACE_TXN_CREATED = 1
+TRACE_TXN_RECIEVED = 2
+TRACE_BLOCK_MINED = 3
+TRACE_BLOCK_ADDED = 4
+TRACE_TIP_CHANGED = 5
+TRACE_HEADER_SIZE = 64 # bytes before the first record of a trace
 
 ############################################################################################################
 
@@ -48,6 +110,18 @@ tot_blks_adversary2 = 0
 
 tot_blks_in_chain = 0
 tot_mined_blks = 0
+payload_kbits_sent = 0 # kilobits of transactions and blocks sent over the links
+inv_kbits_sent = 0 # kilobits of inventory announcements and requests sent over the links
+genesis_balances = None # peer balances of the genesis block
+validation_cache = {} # block id -> (whether the block is valid, peer balances after the block), shared by all the peers
+trace = None # TraceWriter of the simulation, None if the simulation is not traced
+rng = None # RandomStreams of the simulation, None if the random numbers are drawn from the random module
+profiler = None # EventProfiler of the simulation, None if the simulation is not profiled
+
+# purposes of the random streams of a peer
+STREAM_TRANSACTIONS = 0
+STREAM_QUEUING = 1
+STREAM_MINING = 2
 ############################################################################################################
 
 # Transaction class
@@ -58,6 +132,8 @@ class Transaction:
     Transaction class to represent a transaction in the network
     """
 
+    __slots__ = ('sender','reciever','amount','transaction_id','time') # no per-instance __dict__, there are many transactions
+
     def __init__(self,sender,reciever,amount,time):
         """
         Constructor to initialize the transaction
@@ -71,10 +147,16 @@ class Transaction:
         self.reciever = reciever
         self.amount = amount
         global transaction_id
-        transaction_id += 1 # unique id for each transaction
+        transaction_id += id_stride # unique id for each transaction
         self.transaction_id = transaction_id
         self.time = time
 
+    def __getstate__(self):
+        return (self.sender,self.reciever,self.amount,self.transaction_id,self.time)
+
+    def __setstate__(self,state):
+        self.sender,self.reciever,self.amount,self.transaction_id,self.time = state
+
 
 
 class Event:
@@ -83,6 +165,8 @@ class Event:
     Event class to represent an event in the network
     """
 
+    __slots__ = ('scheduled_time','sender_id','reciever_id','item','type','misc') # no per-instance __dict__, there are millions of events
+
     def __init__(self,scheduled_time:float,sender_id:int,reciever_id:int,item:any,type:int,misc = None):
         """
         Constructor to initialize the event
@@ -100,6 +184,12 @@ class Event:
         self.item = item # item associated with the event (transaction or block)
         self.type = type # type of the event
         self.misc = misc # miscellanous data associated with the event
+
+    def __getstate__(self):
+        return (self.scheduled_time,self.sender_id,self.reciever_id,self.item,self.type,self.misc)
+
+    def __setstate__(self,state):
+        self.scheduled_time,self.sender_id,self.reciever_id,self.item,self.type,self.misc = state
     
     def __lt__(self,other):
        """
@@ -112,18 +202,352 @@ class Events:
 
     """
     Events class to represent the list of events in the network
+    Events are kept in a binary heap of (scheduled time, sequence number, event) tuples, so the heap
+    compares the tuples natively and events with the same scheduled time come out in the order they were added
     """
 
     def __init__(self):
-        self.event_list = [] # list of events
+        self.event_list = [] # heap of (scheduled time, sequence number, event)
+        self.sequence = count() # sequence numbers to break ties between events with the same scheduled time
     
     def add_event(self,event: Event): 
-        heapq.heappush(self.event_list,event) # add event to the list
+        heapq.heappush(self.event_list,(event.scheduled_time,next(self.sequence),event)) # add event to the list
     
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["sequence"] = next(self.sequence) # itertools.count cannot be pickled by every Python version
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.sequence = count(state["sequence"])
+
     def get_event(self):
         if len(self.event_list) == 0:
             return None # return None if the list is empty
-        return heapq.heappop(self.event_list) # return the event with the minimum scheduled time and remove it from the list
+        return heapq.heappop(self.event_list)[2] # return the event with the minimum scheduled time and remove it from the list
+
+    def __len__(self):
+        return len(self.event_list)
+
+
+class CalendarQueue:
+
+    """
+    CalendarQueue class to represent the list of events as a calendar queue
+    Events are hashed by their scheduled time into buckets of bucket_width seconds that repeat every
+    no_of_buckets * bucket_width seconds, and the number and width of the buckets follow the size of the queue.
+    Events come out in the same (scheduled time, sequence number) order as Events
+    """
+
+    min_no_of_buckets = 16
+
+    def __init__(self,bucket_width=0.01):
+        """
+        Constructor to initialize the calendar queue
+        Args:
+        bucket_width: initial width of a bucket in seconds
+        """
+        self.sequence = count() # sequence numbers to break ties between events with the same scheduled time
+        self.size = 0 # number of events in the queue
+        self.last_time = 0 # scheduled time of the last event removed from the queue
+        self.resize(self.min_no_of_buckets,bucket_width,[])
+
+    def resize(self,no_of_buckets,bucket_width,entries):
+        """
+        Function to rebuild the buckets with the given number of buckets and bucket width
+        """
+        self.no_of_buckets = no_of_buckets
+        self.bucket_width = bucket_width
+        self.buckets = [[] for _ in range(no_of_buckets)]
+        self.current = int(self.last_time / bucket_width) # number of the current bucket, counted from time 0
+        for entry in entries:
+            self.buckets[int(entry[0] / bucket_width) % no_of_buckets].append(entry)
+        for bucket in self.buckets:
+            heapq.heapify(bucket)
+
+    def rebuild(self,no_of_buckets):
+        """
+        Function to change the number of buckets and estimate a new bucket width
+        from the separation of the earliest events in the queue
+        """
+        entries = [entry for bucket in self.buckets for entry in bucket]
+        earliest = heapq.nsmallest(64,entries)
+        bucket_width = self.bucket_width
+        if len(earliest) > 1 and earliest[-1][0] > earliest[0][0]:
+            bucket_width = 3 * (earliest[-1][0] - earliest[0][0]) / (len(earliest) - 1)
+        self.resize(no_of_buckets,bucket_width,entries)
+
+    def add_event(self,event: Event):
+        entry = (event.scheduled_time,next(self.sequence),event)
+        heapq.heappush(self.buckets[int(entry[0] / self.bucket_width) % self.no_of_buckets],entry)
+        self.size += 1
+        if self.size > 2 * self.no_of_buckets:
+            self.rebuild(2 * self.no_of_buckets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["sequence"] = next(self.sequence) # itertools.count cannot be pickled by every Python version
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.sequence = count(state["sequence"])
+
+    def get_event(self):
+        if self.size == 0:
+            return None # return None if the queue is empty
+        buckets = self.buckets
+        bucket_width = self.bucket_width
+        no_of_buckets = self.no_of_buckets
+        entry = None
+        for _ in range(no_of_buckets):
+            bucket = buckets[self.current % no_of_buckets]
+            # the head of the bucket belongs to this year if it hashes to the current bucket number
+            if bucket and int(bucket[0][0] / bucket_width) <= self.current:
+                entry = heapq.heappop(bucket)
+                break
+            self.current += 1
+        if entry is None:
+            # no event in the next year, jump to the earliest event
+            earliest = min(bucket[0] for bucket in buckets if bucket)
+            self.current = int(earliest[0] / bucket_width)
+            entry = heapq.heappop(buckets[self.current % no_of_buckets])
+        self.size -= 1
+        self.last_time = entry[0]
+        if self.size < self.no_of_buckets // 2 and self.no_of_buckets > self.min_no_of_buckets:
+            self.rebuild(self.no_of_buckets // 2)
+        return entry[2]
+
+    def __len__(self):
+        return self.size
+
+
+def create_event_queue():
+    """
+    Function to create the pending event queue selected by the scheduler parameter
+    """
+    if scheduler == "calendar":
+        return CalendarQueue()
+    if scheduler == "heap":
+        return Events()
+    raise ValueError(f"Unknown scheduler: {scheduler}")
+
+events = create_event_queue() # pending events of the running simulation, Simulation.activate() installs its own queue
+
+
+class RandomStream:
+
+    """
+    RandomStream class to represent one stream of random numbers
+    The exponential and uniform variates are drawn in batches and handed out one by one, the batches start small
+    and double up to max_batch_size, so the streams of the peers that draw few numbers stay small. The generator
+    is only created with the first batch, so the streams of the peers that never draw cost almost nothing
+    """
+
+    max_batch_size = 1024
+
+    def __init__(self,seed,purpose,peer_id):
+        """
+        Constructor to initialize the stream
+        Args:
+        seed: seed of the RandomStreams the stream comes from
+        purpose: STREAM_TRANSACTIONS, STREAM_QUEUING or STREAM_MINING
+        peer_id: id of the peer drawing from the stream
+        """
+        self.key = (seed,purpose,peer_id)
+        self.generator = None # numpy Generator, or random.Random if numpy is not installed
+        self.exponentials = array('d') # batch of exponential variates with rate 1
+        self.next_exponential = 0 # index of the next exponential variate of the batch
+        self.uniforms = array('d') # batch of uniform variates in [0, 1)
+        self.next_uniform = 0 # index of the next uniform variate of the batch
+
+    def refill(self,batch,exponential):
+        """
+        Function to draw the next batch of exponential or uniform variates
+        """
+        if self.generator is None:
+            seed,purpose,peer_id = self.key
+            if np is not None:
+                self.generator = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed,spawn_key=(purpose,peer_id))))
+            else:
+                self.generator = random.Random(f"{seed}:{purpose}:{peer_id}")
+        size = min(self.max_batch_size,max(16,2*len(batch)))
+        batch = array('d')
+        if np is not None:
+            batch.frombytes((self.generator.standard_exponential(size) if exponential else self.generator.random(size)).tobytes())
+        elif exponential:
+            batch.extend(self.generator.expovariate(1) for _ in range(size))
+        else:
+            batch.extend(self.generator.random() for _ in range(size))
+        return batch
+
+    def expovariate(self,lambd):
+        """
+        Function to draw an exponential variate with rate lambd
+        """
+        i = self.next_exponential
+        if i == len(self.exponentials):
+            self.exponentials = self.refill(self.exponentials,True)
+            i = 0
+        self.next_exponential = i + 1
+        return self.exponentials[i] / lambd
+
+    def random(self):
+        """
+        Function to draw a uniform variate in [0, 1)
+        """
+        i = self.next_uniform
+        if i == len(self.uniforms):
+            self.uniforms = self.refill(self.uniforms,False)
+            i = 0
+        self.next_uniform = i + 1
+        return self.uniforms[i]
+
+    def randrange(self,n):
+        """
+        Function to draw an integer in [0, n)
+        """
+        return min(int(self.random() * n),n - 1)
+
+    def transaction(self,sender_id,no_of_peers):
+        """
+        Function to draw the delay until the next transaction of a peer, its reciever (another peer) and its amount
+        """
+        delay = self.expovariate(1 / tmean)
+        reciever = self.randrange(no_of_peers - 1)
+        if reciever >= sender_id:
+            reciever += 1 # skip the sender
+        return delay,reciever,1 + self.randrange(3)
+
+
+class RandomStreams:
+
+    """
+    RandomStreams class to hand out an independent stream of random numbers for every peer and purpose
+    (STREAM_TRANSACTIONS, STREAM_QUEUING, STREAM_MINING)
+    Every stream depends only on the seed, the purpose and the peer, so the numbers a peer draws do not depend on
+    the order in which the peers draw and a run is reproduced exactly from its seed. With numpy every stream is a
+    numpy Generator spawned from one SeedSequence, which guarantees that the streams do not overlap, otherwise a
+    random.Random seeded with the seed, the purpose and the peer (the numbers differ with and without numpy).
+    The peers keep their streams (Peer.use_streams), so a draw is one method call on the stream
+    """
+
+    def __init__(self,seed):
+        """
+        Constructor to initialize the streams
+        Args:
+        seed: non-negative integer, simulations with different seeds have independent streams
+        """
+        self.seed = seed
+
+    def stream(self,purpose,peer_id):
+        """
+        Function to create the stream of a peer for a purpose
+        """
+        return RandomStream(self.seed,purpose,peer_id)
+
+
+class BalanceChanges(dict):
+
+    """
+    BalanceChanges class to collect the balances changed by a block
+    Reading a peer that is not changed yet returns its balance before the block
+    """
+
+    def __init__(self,base):
+        """
+        Constructor to initialize the changes
+        Args:
+        base: peer balances before the block
+        """
+        super().__init__()
+        self.base = base
+
+    def __missing__(self,peer_id):
+        balance = self.base[peer_id]
+        self[peer_id] = balance
+        return balance
+
+
+class PeerBalances:
+
+    """
+    PeerBalances class to represent the peer balances after a block
+    Only the balances changed by the block are stored, and a full array of balances
+    is stored every balance_checkpoint_interval blocks, so a lookup walks at most that many blocks
+    """
+
+    __slots__ = ('parent','changes','balances','distance')
+
+    def __init__(self,parent=None,changes=None,balances=None):
+        """
+        Constructor to initialize the peer balances
+        Args:
+        parent: peer balances before the block (None for a checkpoint)
+        changes: peer id -> balance for the peers changed by the block
+        balances: array of all the balances if this is a checkpoint
+        """
+        self.parent = parent
+        self.changes = changes if changes is not None else {}
+        self.balances = balances
+        self.distance = 0 if balances is not None else parent.distance + 1 # number of blocks since the last checkpoint
+
+    def __getitem__(self,peer_id):
+        node = self
+        while node.balances is None:
+            if peer_id in node.changes:
+                return node.changes[peer_id]
+            node = node.parent
+        return node.balances[peer_id]
+
+    def begin(self):
+        """
+        Function to start collecting the balance changes of a block on top of these balances
+        """
+        return BalanceChanges(self)
+
+    def apply(self,changes):
+        """
+        Function to create the peer balances after a block with the given changes
+        """
+        child = PeerBalances(self,dict(changes))
+        if child.distance >= balance_checkpoint_interval:
+            child.make_checkpoint()
+        return child
+
+    def make_checkpoint(self):
+        """
+        Function to store the full array of balances and drop the link to the previous balances
+        """
+        self.balances = array('q',self.to_list())
+        self.parent = None
+        self.distance = 0
+
+    def to_list(self):
+        """
+        Function to get all the balances as a list
+        """
+        chain = []
+        node = self
+        while node.balances is None:
+            chain.append(node)
+            node = node.parent
+        balances = list(node.balances)
+        for i in reversed(chain):
+            for peer_id,balance in i.changes.items():
+                balances[peer_id] = balance
+        return balances
+
+
+def genesis_peer_balances():
+    """
+    Function to get the peer balances of the genesis block, shared by all the peers
+    """
+    global genesis_balances
+    if genesis_balances is None or len(genesis_balances.balances) != no_of_peers:
+        genesis_balances = PeerBalances(balances=array('q',[initial_balance])*no_of_peers)
+    return genesis_balances
 
 
 class Block:
@@ -132,7 +556,9 @@ class Block:
     Block class to represent a block in the blockchain
     """
 
-    def __init__(self,transactions_list:list,prev_block_id:int,creator_id:int,time:float,peer_balances:list):
+    __slots__ = ('transactions_list','block_id','prev_block_id','creator_id','time','parent','children','block_size','depth','peer_balances','skip')
+
+    def __init__(self,transactions_list:list,prev_block_id:int,creator_id:int,time:float,peer_balances:PeerBalances):
         """
         Constructor to initialize the block
         Args:
@@ -148,7 +574,7 @@ class Block:
             self.block_id = 0 # genesis block
         else:
             global block_id # unique id for each block
-            block_id += 1
+            block_id += id_stride
             self.block_id = block_id
         self.prev_block_id = prev_block_id # id of the previous block
         self.creator_id = creator_id # id of the creator of the block
@@ -158,6 +584,18 @@ class Block:
         self.block_size = 8 * (1 + len(transactions_list)) # in Kilobits
         self.depth = 0 # depth of the block in the blockchain
         self.peer_balances = peer_balances # peer balances after the transactions in the block
+        self.skip = None # ancestor at depth skip_depth(depth), set when the block is added to a blockchain
+
+    def __getstate__(self):
+        # the parent and children are not saved, following them would save the whole tree recursively
+        # Network.relink_blocks links the blocks again from the blockchains of the peers
+        # following the skip pointers only saves O(log(depth)) blocks recursively
+        return (self.transactions_list,self.block_id,self.prev_block_id,self.creator_id,self.time,self.block_size,self.depth,self.peer_balances,self.skip)
+
+    def __setstate__(self,state):
+        self.transactions_list,self.block_id,self.prev_block_id,self.creator_id,self.time,self.block_size,self.depth,self.peer_balances,self.skip = state
+        self.parent = None
+        self.children = []
     
     def add_child(self,child):
 
@@ -169,8 +607,96 @@ class Block:
         child.parent = self # set the parent of the child block
         child.depth = self.depth + 1 # set the depth of the child block
         child.prev_block_id = self.block_id # set the previous block id of the child block
+        if child.skip is None: # the blocks are shared by the peers, so the skip pointer is only set by the first one
+            child.skip = self.ancestor(skip_depth(child.depth))
         return child
+
+    def ancestor(self,depth):
+        """
+        Function to get the ancestor of the block at a depth (the block itself at its own depth)
+        The skip pointers make this O(log(depth of the block)) steps
+        Returns None if the depth is negative or greater than the depth of the block
+        """
+        if depth < 0 or depth > self.depth:
+            return None
+        block = self
+        while block.depth > depth:
+            skip = skip_depth(block.depth)
+            skip_previous = skip_depth(block.depth - 1)
+            # take the skip pointer unless it overshoots, or the previous block has a better skip pointer
+            if block.skip is not None and (skip == depth or (skip > depth and not (skip_previous < skip - 2 and skip_previous >= depth))):
+                block = block.skip
+            else:
+                block = block.parent
+        return block
+
+    def kth_ancestor(self,k):
+        """
+        Function to get the k-th ancestor of the block (the parent for k = 1), None if the chain is shorter
+        """
+        return self.ancestor(self.depth - k)
+
+
+def skip_depth(depth):
+    """
+    Function to get the depth of the ancestor a block at a depth points to with its skip pointer
+    The depths are chosen as in Bitcoin Core, so that any ancestor is reached in O(log(depth)) steps
+    """
+    if depth < 2:
+        return 0
+    if depth & 1:
+        depth -= 1
+        depth &= depth - 1 # clear the lowest set bit twice
+        depth &= depth - 1
+        return depth + 1
+    return depth & (depth - 1)
+
+def common_ancestor(block1,block2):
+    """
+    Function to get the last common ancestor of two blocks, in O(log(depth)^2) steps
+    The genesis block is a different object for every peer, so the blocks are compared by id
+    """
+    depth = min(block1.depth,block2.depth)
+    block1 = block1.ancestor(depth)
+    block2 = block2.ancestor(depth)
+    if block1.block_id == block2.block_id:
+        return block1
+    # the ancestors at a depth are the same up to the common ancestor and different after it
+    low,high = 0,depth - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if block1.ancestor(middle).block_id == block2.ancestor(middle).block_id:
+            low = middle
+        else:
+            high = middle - 1
+    return block1.ancestor(low)
+
+def reorg_depth(old_tip,new_tip):
+    """
+    Function to get the number of blocks of the chain of old_tip that leave the longest chain when it switches to new_tip
+    """
+    return old_tip.depth - common_ancestor(old_tip,new_tip).depth
+
+def common_prefix(tips):
+    """
+    Function to get the last block that is in the chains of all the tips
+    """
+    tips = iter(tips)
+    prefix = next(tips)
+    for tip in tips:
+        prefix = common_ancestor(prefix,tip)
+        if prefix.depth == 0:
+            break
+    return prefix
         
+def compact_block_size(block):
+    """
+    Function to get the size of a block sent as a compact block:
+    the header and coinbase transaction in full and a short id for every other transaction
+    """
+    return size_of_transaction + short_id_size * (len(block.transactions_list) - 1)
+
+
 class BlockChain:
 
     """
@@ -178,10 +704,13 @@ class BlockChain:
     """
 
     def __init__(self):
-        self.root = Block([],-1,-1,0,[100]*no_of_peers) # genesis block
-        self.seen_blocks = [self.root] # list of blocks seen by the blockchain
+        self.root = Block([],-1,-1,0,genesis_peer_balances()) # genesis block
+        self.block_index = {self.root.block_id: self.root} # block id -> block, in insertion order (a block after its parent)
         self.max_depth = 0 # maximum depth of the blockchain
         self.longest_chain_id = 0 # block id of the  last block in the longest chain
+        self.final_depth = 0 # depth of the final block, see Network.prune_blocks
+        self.final_block = self.root # final block, the blocks of the chain before it (except the genesis block) leave block_index
+        self.unfinalized_blocks = [] # blocks added since the last pruning that were not final then, with finality_depth
 
     def add_block(self,block):
         """
@@ -190,7 +719,9 @@ class BlockChain:
         True if the block is added to the blockchain and the longest chain is updated
         False if the block is added to the blockchain but the longest chain is not updated
         """
-        self.seen_blocks.append(block) # add the block to the list of seen blocks
+        self.block_index[block.block_id] = block # index the block by its id
+        if finality_depth is not None:
+            self.unfinalized_blocks.append(block)
         self.prev_block = self.find_block(block.prev_block_id) # find the previous block
         self.prev_block.add_child(block) # add the block as a child of the previous block
         if block.depth > self.max_depth: # check if the longest chain is updated
@@ -201,15 +732,150 @@ class BlockChain:
 
     def find_block(self,block_id):
         """
-        Function to find a block in the blockchain using block id 
+        Function to find a block in the blockchain using block id
+        Returns None if the block is not in the blockchain
         """
-        for i in self.seen_blocks:
-            if i.block_id == block_id:
-                return i
+        return self.block_index.get(block_id)
 
+    def has_block(self,block):
+        """
+        Function to check if a block is already in the blockchain
+        """
+        return block.block_id in self.block_index
+
+    def is_final(self,block):
+        """
+        Function to check if a block is the final block or one of the blocks of the chain before it
+        """
+        return block.depth <= self.final_depth and self.final_block.ancestor(block.depth).block_id == block.block_id
+
+    def extends_final_block(self,block):
+        """
+        Function to check if a block is the final block or one of its descendants
+        The other blocks are either final or on a stale branch forking off below the final block
+        """
+        return block.depth >= self.final_depth and block.ancestor(self.final_depth).block_id == self.final_block.block_id
+
+    def prune(self,final_block):
+        """
+        Function to remove the stale branches forking off the chain of final_block below it,
+        the blocks that are neither ancestors nor descendants of final_block, and the blocks of the chain
+        before final_block except the genesis block: final_block stays as the anchor of the blockchain
+        Only the blocks added since the last pruning are checked
+        Returns the removed blocks of the stale branches
+        """
+        final_depth = final_block.depth
+        pruned = []
+        unfinalized = []
+        for block in self.unfinalized_blocks:
+            if block.depth <= final_depth:
+                if final_block.ancestor(block.depth).block_id == block.block_id:
+                    if block.depth < final_depth:
+                        del self.block_index[block.block_id] # the block is final
+                    continue
+            elif block.ancestor(final_depth).block_id == final_block.block_id:
+                unfinalized.append(block)
+                continue
+            pruned.append(block)
+            del self.block_index[block.block_id]
+        if self.final_block is not self.root and self.final_block.block_id != final_block.block_id:
+            del self.block_index[self.final_block.block_id] # the previous anchor
+        self.unfinalized_blocks = unfinalized
+        self.final_depth = final_depth
+        self.final_block = final_block
+        return pruned
+
+
+class Mempool:
+
+    """
+    Mempool class to keep the transactions seen by a peer that are not yet in its longest chain
+    """
+
+    def __init__(self,tip,max_size=None,max_confirmed=None):
+        """
+        Constructor to initialize the mempool
+        Args:
+        tip: last block of the chain the mempool is tracking (the genesis block initially)
+        max_size: maximum number of unconfirmed transactions, the oldest are evicted first
+        max_confirmed: maximum number of confirmed transaction ids remembered, the oldest are forgotten first
+        """
+        self.tip = tip # last block of the chain the confirmed transactions belong to
+        self.max_size = max_size if max_size is not None else max_mempool_size
+        self.max_confirmed = max_confirmed if max_confirmed is not None else max_seen_transactions
+        self.unconfirmed = OrderedDict() # transaction id -> transaction, in the order the transactions were seen
+        self.confirmed = OrderedDict() # ids of the transactions in the chain ending at tip, oldest first
+        self.no_of_evicted = 0 # number of unconfirmed transactions evicted because the mempool was full
+
+    def add_transaction(self,txn):
+        """
+        Function to add a newly seen transaction to the mempool
+        """
+        if txn.transaction_id in self.confirmed:
+            return
+        self.unconfirmed[txn.transaction_id] = txn
+        if len(self.unconfirmed) > self.max_size:
+            self.unconfirmed.popitem(last=False) # evict the oldest unconfirmed transaction
+            self.no_of_evicted += 1
+
+    def confirm(self,txn_id):
+        """
+        Function to mark a transaction as confirmed in the tracked chain
+        """
+        self.unconfirmed.pop(txn_id,None)
+        self.confirmed[txn_id] = None
+        if len(self.confirmed) > self.max_confirmed:
+            self.confirmed.popitem(last=False) # forget the oldest confirmation
+
+    def update_tip(self,new_tip):
+        """
+        Function to move the mempool to a new tip
+        Only the blocks between the old tip and the new tip are visited, so a fork switch
+        costs the size of the diff and not the length of the chain
+        """
+        old_tip = self.tip
+        if new_tip is old_tip:
+            return
+        detached = [] # blocks leaving the tracked chain
+        attached = [] # blocks joining the tracked chain
+        while old_tip.depth > new_tip.depth:
+            detached.append(old_tip)
+            old_tip = old_tip.parent
+        while new_tip.depth > old_tip.depth:
+            attached.append(new_tip)
+            new_tip = new_tip.parent
+        while old_tip.block_id != new_tip.block_id:
+            # the genesis block is a different object for every peer, so compare the ids
+            detached.append(old_tip)
+            attached.append(new_tip)
+            old_tip = old_tip.parent
+            new_tip = new_tip.parent
+
+        # transactions of the blocks that left the chain go back to the mempool
+        # (a mempool left on a branch forking off below the final block meets final blocks, which have no transactions)
+        for block in detached:
+            for txn in block.transactions_list or ():
+                if txn.sender == coinbase_id:
+                    continue
+                self.confirmed.pop(txn.transaction_id,None)
+                self.add_transaction(txn)
+
+        # transactions of the blocks that joined the chain are confirmed
+        for block in reversed(attached):
+            for txn in block.transactions_list or ():
+                if txn.sender == coinbase_id:
+                    continue
+                self.confirm(txn.transaction_id)
+
+        self.tip = attached[0] if attached else old_tip
+
+    def get_transactions(self,limit):
+        """
+        Function to get at most limit unconfirmed transactions, oldest first
+        """
+        return list(islice(self.unconfirmed.values(),limit))
 
 
-        
 class Peer:
 
     """
@@ -228,32 +894,57 @@ class Peer:
         self.id = id
         self.is_slow = is_slow
         self.BlockChain = BlockChain()
-        self.adjacency_list = [0]*no_of_peers
+        self.adjacency_list = None # filled by Network.create_adjacency_list
         self.neighbours = [] # list of connected neighbours
         self.hashing_power = hashing_power
-        self.transactions_list = []
-        self.unaccepted_blocks = [] # list of unaccepted blocks
+        self.seen_transactions = OrderedDict() # ids of the recently seen transactions, oldest first
+        self.requested_transactions = set() # ids of the announced transactions requested from a neighbour
+        self.requested_blocks = set() # ids of the announced blocks requested from a neighbour
+        self.mempool = Mempool(self.BlockChain.root) # transactions not yet in the longest chain
+        self.orphan_blocks = {} # parent block id -> blocks waiting for the parent to be added to the blockchain
+        self.orphan_ids = set() # ids of the blocks in orphan_blocks
+        self.invalid_blocks = set() # ids of the blocks found invalid, and of their descendants, which are dropped
+        self.pruned_blocks = {} # block id -> depth of the recently pruned blocks seen by the peer, see Network.prune_blocks
         self.no_of_created_blocks = 0
         self.is_selfish = selfish
-        self.selfish_blocks = [] # list of selfish blocks
+        self.selfish_blocks = deque() # selfish blocks not released yet, oldest first
+        self.honest_depth = 0 # depth of the longest chain without the selfish blocks not released yet
+        self.honest_tip_id = 0 # block id of the last block of that chain
         self.parent_block = None # parent block
         self.lead = 0 # lead of the selfish miner
+        self.use_streams(None)
     
+    def use_streams(self,streams):
+        """
+        Function to give the peer its random streams
+        Args:
+        streams: RandomStreams of the simulation, None to draw the random numbers from the random module
+        """
+        if streams is None:
+            self.transaction_stream = self.queuing_stream = self.mining_stream = None
+        else:
+            self.transaction_stream = streams.stream(STREAM_TRANSACTIONS,self.id)
+            self.queuing_stream = streams.stream(STREAM_QUEUING,self.id)
+            self.mining_stream = streams.stream(STREAM_MINING,self.id)
+
     def create_Transaction(self,txn,time):
         """
         Function to create a transaction
         """
-        for i in self.neighbours: # forward the transaction to the neighbours
-            queuing_delay = random.expovariate(N.link_speeds[self.id][i]/queing_delay_constant) # queuing delay
-            frwd_event = Event(time+queuing_delay,self.id,i,txn,FORWARD_TXN) # create a forward event
-            events.add_event(frwd_event) # add the forward event to the list of events
+        if trace is not None and trace.transactions:
+            trace.write(TRACE_TXN_CREATED,time,self.id,txn.transaction_id,aux=txn.reciever)
+        self.relay_transaction(txn,time) # forward the transaction to the neighbours
         
         # schedule the next transaction
-        next_transaction_time = time + random.expovariate(1 / tmean) # time of the next transaction
-        next_reciever = random.sample(range(no_of_peers),1)[0] # reciever of the next transaction
-        while next_reciever == self.id:
-            next_reciever =  random.sample(range(no_of_peers),1)[0]
-        next_amount = random.randint(1,3)
+        if self.transaction_stream is not None:
+            delay,next_reciever,next_amount = self.transaction_stream.transaction(self.id,no_of_peers)
+            next_transaction_time = time + delay
+        else:
+            next_transaction_time = time + random.expovariate(1 / tmean) # time of the next transaction
+            next_reciever = random.sample(range(no_of_peers),1)[0] # reciever of the next transaction
+            while next_reciever == self.id:
+                next_reciever =  random.sample(range(no_of_peers),1)[0]
+            next_amount = random.randint(1,3)
         next_txn = Transaction(self.id,next_reciever,next_amount,next_transaction_time)
         event = Event(next_transaction_time,self.id,next_reciever,next_txn,CREATE_TXN)
         events.add_event(event)
@@ -264,193 +955,342 @@ class Peer:
         """
         Function to recieve a transaction
         """
-        if txn in self.transactions_list: # check if the transaction is already seen
+        self.requested_transactions.discard(txn.transaction_id)
+        if txn.transaction_id in self.seen_transactions: # check if the transaction is already seen
             pass
         else:
-            self.transactions_list.append(txn) # add the transaction to the list of seen transactions
-            for i in self.neighbours:
-                if i == sender_id: # forward the transaction to the neighbours and not the sender
-                    continue
-                queuing_delay = random.expovariate(N.link_speeds[self.id][i]/queing_delay_constant)
-                event = Event(time+queuing_delay,self.id,i,txn,FORWARD_TXN)
-                events.add_event(event)
+            self.seen_transactions[txn.transaction_id] = None # add the transaction to the seen transactions
+            if len(self.seen_transactions) > max_seen_transactions:
+                self.seen_transactions.popitem(last=False) # forget the oldest seen transaction
+            self.mempool.add_transaction(txn)
+            if trace is not None and trace.transactions:
+                trace.write(TRACE_TXN_RECIEVED,time,self.id,txn.transaction_id,aux=sender_id)
+            self.relay_transaction(txn,time,sender_id) # forward the transaction to the neighbours and not the sender
 
 
     def forward_transaction(self,txn,reciever_id,time):
         """
         Function to forward a transaction
         """
-        prop_delay = N.propgation_delay[self.id][reciever_id]
-        transmission_delay = (size_of_transaction/N.link_speeds[self.id][reciever_id])
+        prop_delay = N.propagation_delay(self.id,reciever_id)
+        transmission_delay = (size_of_transaction/N.link_speed(self.id,reciever_id))
         event = Event(time+prop_delay+transmission_delay,self.id,reciever_id,txn,RECIEVE_TXN)
         events.add_event(event)
 
-	
-	
+    def relay_transaction(self,txn,time,sender_id=None):
+        """
+        Function to relay a transaction to the neighbours except the sender
+        """
+        self.relay(txn,time,sender_id,size_of_transaction,FORWARD_TXN,RECIEVE_TXN,FANOUT_TXN)
+
+    def relay_block(self,block,time,sender_id=None):
+        """
+        Function to relay a block to the neighbours except the sender
+        """
+        if compact_blocks:
+            self.relay(block,time,sender_id,compact_block_size(block),FORWARD_BLOCK,RECIEVE_CMPCT_BLOCK,FANOUT_BLOCK)
+        else:
+            self.relay(block,time,sender_id,block.block_size,FORWARD_BLOCK,RECIEVE_BLOCK,FANOUT_BLOCK)
+
+    def relay(self,item,time,sender_id,size,forward_type,recieve_type,fanout_type):
+        """
+        Function to schedule the delivery of an item to the neighbours except the sender
+        Every relay mode gives the same delay: queuing delay + propagation delay + transmission delay
+        """
+        global payload_kbits_sent
+        if relay_protocol == "inv":
+            self.announce(item,time,sender_id,recieve_type)
+            return
+        if relay_protocol != "push":
+            raise ValueError(f"Unknown relay protocol: {relay_protocol}")
+
+        if relay_mode == "classic":
+            # the forward event adds the propagation and transmission delay when it is processed
+            for i in self.neighbours:
+                if i == sender_id:
+                    continue
+                if self.queuing_stream is not None:
+                    queuing_delay = self.queuing_stream.expovariate(N.link_speed(self.id,i)/queing_delay_constant)
+                else:
+                    queuing_delay = random.expovariate(N.link_speed(self.id,i)/queing_delay_constant)
+                events.add_event(Event(time+queuing_delay,self.id,i,item,forward_type))
+                payload_kbits_sent += size
+            return
+
+        deliveries = [] # (delivery time, reciever id)
+        for i in self.neighbours:
+            if i == sender_id:
+                continue
+            deliveries.append((self.delivery_time(i,time,size),i))
+        if not deliveries:
+            return
+        payload_kbits_sent += size * len(deliveries)
+        if relay_mode == "fused":
+            for delivery_time,i in deliveries:
+                events.add_event(Event(delivery_time,self.id,i,item,recieve_type))
+        elif relay_mode == "fanout":
+            deliveries.sort(reverse=True) # the next delivery is at the end of the list
+            events.add_event(Event(deliveries[-1][0],self.id,None,item,fanout_type,deliveries))
+        else:
+            raise ValueError(f"Unknown relay mode: {relay_mode}")
+
+    def delivery_time(self,reciever_id,time,size):
+        """
+        Function to get the time at which an item of the given size sent at time reaches a neighbour
+        """
+        link_speed = N.link_speed(self.id,reciever_id)
+        if self.queuing_stream is not None:
+            queuing_delay = self.queuing_stream.expovariate(link_speed/queing_delay_constant)
+        else:
+            queuing_delay = random.expovariate(link_speed/queing_delay_constant)
+        return time + queuing_delay + N.propagation_delay(self.id,reciever_id) + size/link_speed
+
+    def has_item(self,item,recieve_type):
+        """
+        Function to check if the peer already has, or has already requested, a transaction or a block
+        """
+        if recieve_type == RECIEVE_TXN:
+            return item.transaction_id in self.seen_transactions or item.transaction_id in self.requested_transactions
+        return self.has_seen_block(item) or item.block_id in self.requested_blocks
+
+    def announce(self,item,time,sender_id,recieve_type):
+        """
+        Function to announce an item to the neighbours except the sender
+        The item itself is only sent to the neighbours that request it
+        """
+        global inv_kbits_sent
+        for i in self.neighbours:
+            if i == sender_id:
+                continue
+            events.add_event(Event(self.delivery_time(i,time,inv_message_size),self.id,i,item,RECIEVE_INV,recieve_type))
+            inv_kbits_sent += inv_message_size
+
+    def recieve_inv(self,item,sender_id,time,recieve_type):
+        """
+        Function to recieve the announcement of an item and request it from the sender if it is new
+        """
+        global inv_kbits_sent
+        if self.has_item(item,recieve_type):
+            return
+        if recieve_type == RECIEVE_TXN:
+            self.requested_transactions.add(item.transaction_id)
+        else:
+            self.requested_blocks.add(item.block_id)
+        request_time = time + N.propagation_delay(self.id,sender_id) + inv_message_size/N.link_speed(self.id,sender_id)
+        events.add_event(Event(request_time,self.id,sender_id,item,RECIEVE_GETDATA,recieve_type))
+        inv_kbits_sent += inv_message_size
+
+    def recieve_getdata(self,item,reciever_id,time,recieve_type):
+        """
+        Function to send a requested item to the neighbour that requested it
+        """
+        global payload_kbits_sent
+        if recieve_type == RECIEVE_TXN:
+            size = size_of_transaction
+        elif recieve_type == RECIEVE_CMPCT_BLOCK:
+            size = compact_block_size(item)
+        else:
+            size = item.block_size
+        events.add_event(Event(self.delivery_time(reciever_id,time,size),self.id,reciever_id,item,recieve_type))
+        payload_kbits_sent += size
+
+    def fan_out(self,event):
+        """
+        Function to deliver the item of a fan-out event to the next neighbour
+        and schedule the event again for the neighbour after it
+        """
+        deliveries = event.misc
+        time,reciever_id = deliveries.pop()
+        if deliveries:
+            event.scheduled_time = deliveries[-1][0]
+            events.add_event(event)
+        if event.type == FANOUT_TXN:
+            N.peers[reciever_id].recieve_transaction(event.item,self.id,time)
+        elif compact_blocks:
+            N.peers[reciever_id].recieve_compact_block(event.item,self.id,time)
+        else:
+            N.peers[reciever_id].recieve_block(event.item,time,self.id)
+
+    def recieve_compact_block(self,block,sender_id,time):
+        """
+        Function to recieve a compact block
+        The block is rebuilt from the transactions the peer has seen, and the missing transactions
+        are requested from the sender
+        """
+        global inv_kbits_sent
+        if self.has_seen_block(block):
+            return
+        no_of_missing = 0
+        for i in block.transactions_list:
+            if i.sender != coinbase_id and i.transaction_id not in self.seen_transactions:
+                no_of_missing += 1
+        if no_of_missing == 0:
+            self.recieve_block(block,time,sender_id)
+            return
+        request_size = inv_message_size + short_id_size * no_of_missing
+        request_time = time + N.propagation_delay(self.id,sender_id) + request_size/N.link_speed(self.id,sender_id)
+        events.add_event(Event(request_time,self.id,sender_id,block,RECIEVE_GETBLOCKTXN,no_of_missing))
+        inv_kbits_sent += request_size
+
+    def recieve_getblocktxn(self,block,reciever_id,time,no_of_missing):
+        """
+        Function to send the transactions of a compact block that the reciever is missing
+        The block is delivered to the reciever once the missing transactions arrive
+        """
+        global payload_kbits_sent
+        size = size_of_transaction * no_of_missing
+        events.add_event(Event(self.delivery_time(reciever_id,time,size),self.id,reciever_id,block,RECIEVE_BLOCK))
+        payload_kbits_sent += size
+
+    def add_block(self,block,time):
+        """
+        Function to add a block to the blockchain of the peer
+        Returns True if the longest chain is updated, like BlockChain.add_block
+        """
+        updated = self.BlockChain.add_block(block)
+        if not (self.is_selfish and block.creator_id == self.id): # the blocks mined by a selfish miner are withheld
+            self.update_honest_chain(block)
+        if trace is not None:
+            trace.write(TRACE_BLOCK_ADDED,time,self.id,block.block_id,block.prev_block_id,block.depth,block.creator_id)
+            if updated:
+                trace.write(TRACE_TIP_CHANGED,time,self.id,block.block_id,block.prev_block_id,block.depth,block.creator_id)
+        return updated
+
+    def has_seen_block(self,block):
+        """
+        Function to check if a block is already in the blockchain, waiting for its parent or dropped as invalid
+        """
+        return self.BlockChain.has_block(block) or block.block_id in self.orphan_ids or block.block_id in self.invalid_blocks or block.block_id in self.pruned_blocks
+
     def recieve_block(self,block,time,sender_id):
 
         """
         Function to recieve a block
         """
+        self.requested_blocks.discard(block.block_id)
+        if self.has_seen_block(block): # check if the block is already seen
+            return
+        if self.BlockChain.final_depth > 0 and not self.BlockChain.extends_final_block(block):
+            # a final block seen before, or a block on a stale branch forking off below the final block
+            if not self.BlockChain.is_final(block) and block.depth + finality_depth > self.BlockChain.final_depth:
+                self.pruned_blocks[block.block_id] = block.depth
+                if not self.is_selfish:
+                    self.relay_block(block,time,sender_id) # forwarded as if the branch was kept, so pruning does not change the run
+            return
+        parent = self.BlockChain.find_block(block.prev_block_id)
+        if parent is None: # check if the previous block is seen
+            # keep the block until the previous block arrives, honest peers forward it to the neighbours
+            self.orphan_blocks.setdefault(block.prev_block_id,[]).append(block)
+            self.orphan_ids.add(block.block_id)
+            if not self.is_selfish:
+                self.relay_block(block,time,sender_id)
+            return
+        if not self.accept_block(block,time): # drop the block if it is not valid
+            return
+        if not self.is_selfish:
+            self.relay_block(block,time,sender_id) # forward the block to the neighbours and not the sender
+        self.attach_orphans(block,time)
+
+    def accept_block(self,block,time):
+        """
+        Function to validate a block whose previous block is in the blockchain and add it to the blockchain
+        A selfish miner releases its blocks when the honest chain catches up with its private chain
+        Returns False if the block is not valid, it is then dropped
+        """
+        if not self.validate_block(block): # validate the block
+            self.invalid_blocks.add(block.block_id)
+            return False
         if self.is_selfish:
-            if block in self.BlockChain.seen_blocks: # check if the block is already seen
-                return
+            honest_chain_length = self.longest_chain() # length of the honest longest chain
+        if self.add_block(block,time): # add the block to the blockchain and if the longest chain is updated, schedule the next block creation
+            event = Event(time,self.id,None,None,CREATE_BLOCK)
+            events.add_event(event)
+        if self.is_selfish and block.depth > honest_chain_length: # check if the longest honest chain is updated
+            if len(self.selfish_blocks) == 0:
+                lead_diff = 0
             else:
-                honest_chain_length = self.longest_chain() # length of the honest longest chain
-
-                if self.BlockChain.find_block(block.prev_block_id)!= None: # check if the previous block is seen
-                    if(self.validate_block(block)): # validate the block
-                        if self.BlockChain.add_block(block): # add the block to the blockchain and if the longest chain is updated, schedule the next block creation
-                            
-                            # schedule the next block creation if the longest chain is updated
-                            event = Event(time,self.id,None,None,CREATE_BLOCK) 
-                            events.add_event(event)
-                        if block.depth > honest_chain_length: # check if the longest honest chain is updated
-                            if len(self.selfish_blocks) == 0:
-                                lead_diff = 0
-                            else:  
-                                lead_diff = self.selfish_blocks[-1].depth - block.depth # lead difference
-                            if lead_diff < 2:
-                                # this covers the both case 1 and case 2 of the assignment statement
-                                self.release_all_selfish_blks(time) # release all the selfish blocks if the lead difference is less than 2
-                                
-                            else:
-                                    # if the lead difference is greater than 2, forward one block
-                                    # for everyone one block recievd to the neighbours
-                                    blk = self.selfish_blocks[0]
-                                    for i in self.neighbours:
-                                        queuing_delay = random.expovariate(N.link_speeds[self.id][i]/queing_delay_constant)
-                                        event = Event(time+queuing_delay,self.id,i,blk,FORWARD_BLOCK)
-                                        events.add_event(event)
-                                    self.selfish_blocks.pop(0)
-
-                                
-                        for i in self.unaccepted_blocks:
-                            # check if the unaccepted blocks can be added to the blockchain
-                            if self.BlockChain.find_block(i.prev_block_id)!= None:
-                                honest_chain_length = self.longest_chain()
-                                if self.BlockChain.add_block(i):
-                                    # schedule the next block creation if the longest chain is updated
-                                    event = Event(time,self.id,None,None,CREATE_BLOCK)
-                                    events.add_event(event)
-                                self.unaccepted_blocks.remove(i) # remove the block from the list of unaccepted blocks
-                                if i.depth > honest_chain_length:
-                                    if len(self.selfish_blocks) == 0:
-                                        lead_diff = 0
-                                    else:  
-                                        lead_diff = self.selfish_blocks[-1].depth - i.depth
-                                    if lead_diff < 2:
-                                        self.release_all_selfish_blks(time)
-                                    else:
-                                        blk = self.selfish_blocks[0]
-                                        for i in self.neighbours:
-                                            queuing_delay = random.expovariate(N.link_speeds[self.id][i]/queing_delay_constant)
-                                            event = Event(time+queuing_delay,self.id,i,blk,FORWARD_BLOCK)
-                                            events.add_event(event)
-                                        self.selfish_blocks.pop(0)
-                    else:
-                        # add the block to the list of unaccepted blocks if the block is not valid 
-                        self.unaccepted_blocks.append(block)
-                else:
-                    self.unaccepted_blocks.append(block)
-            
-                        
-            
-
-        else:
-            if block in self.BlockChain.seen_blocks: # check if the block is already seen
-                return
+                lead_diff = self.selfish_blocks[-1].depth - block.depth # lead difference
+            if lead_diff < 2:
+                # this covers the both case 1 and case 2 of the assignment statement
+                self.release_all_selfish_blks(time) # release all the selfish blocks if the lead difference is less than 2
             else:
-                if self.BlockChain.find_block(block.prev_block_id)!= None: # check if the previous block is seen
-                    if(self.validate_block(block)): # validate the block
-                        if self.BlockChain.add_block(block): # add the block to the blockchain and if the longest chain is updated, schedule the next block creation
-                            
-                            # schedule the next block creation if the longest chain is updated
-                            event = Event(time,self.id,None,None,CREATE_BLOCK) 
-                            events.add_event(event)
-                            
-
-                        for i in self.neighbours:
-                            if i == sender_id: # forward the block to the neighbours and not the sender
-                                continue
-                            queuing_delay = random.expovariate(N.link_speeds[self.id][i]/queing_delay_constant)
-                            event = Event(time+queuing_delay,self.id,i,block,FORWARD_BLOCK)
-                            events.add_event(event)
-                            
-                        for i in self.unaccepted_blocks:
-                            # check if the unaccepted blocks can be added to the blockchain
-                            if self.BlockChain.find_block(i.prev_block_id)!= None:
-                                if self.BlockChain.add_block(i):
-                                    # schedule the next block creation if the longest chain is updated
-                                    event = Event(time,self.id,None,None,CREATE_BLOCK)
-                                    events.add_event(event)
-                                self.unaccepted_blocks.remove(i) # remove the block from the list of unaccepted blocks
-                    else:
-                        # add the block to the list of unaccepted blocks if the block is not valid 
-                        # and forward it to the neighbours
-                        self.unaccepted_blocks.append(block)
-                        for i in self.neighbours:
-                            if i == sender_id:
-                                continue
-                            queuing_delay = random.expovariate(N.link_speeds[self.id][i]/queing_delay_constant)
-                            event = Event(time+queuing_delay,self.id,i,block,FORWARD_BLOCK)
-                            events.add_event(event)
+                # if the lead difference is greater than 2, forward one block
+                # for everyone one block recievd to the neighbours
+                blk = self.selfish_blocks.popleft()
+                self.relay_block(blk,time)
+                self.update_honest_chain(blk)
+        return True
 
+    def attach_orphans(self,block,time):
+        """
+        Function to add the blocks waiting for a block that was just added to the blockchain, and the blocks
+        waiting for them in turn, so the work is proportional to the number of blocks attached
+        The blocks waiting for an invalid block are invalid too and are dropped
+        """
+        parents = [block.block_id] # ids of the blocks whose waiting blocks are not attached yet
+        while parents:
+            parent_id = parents.pop()
+            for orphan in self.orphan_blocks.pop(parent_id,()):
+                self.orphan_ids.discard(orphan.block_id)
+                if parent_id in self.invalid_blocks:
+                    self.invalid_blocks.add(orphan.block_id)
                 else:
-                    # add the block to the list of unaccepted blocks if the previous block is not seen
-                    # and forward it to the neighbours
-                    self.unaccepted_blocks.append(block)
-                    for i in self.neighbours:
-                        if i == sender_id:
-                            continue
-                        queuing_delay = random.expovariate(N.link_speeds[self.id][i]/queing_delay_constant)
-                        event = Event(time+queuing_delay,self.id,i,block,FORWARD_BLOCK)
-                        events.add_event(event)
+                    self.accept_block(orphan,time)
+                parents.append(orphan.block_id)
+
+    def drop_orphans(self,parent_id):
+        """
+        Function to drop the blocks waiting for a block of a pruned branch, and the blocks waiting for them in turn
+        """
+        parents = [parent_id]
+        while parents:
+            for orphan in self.orphan_blocks.pop(parents.pop(),()):
+                self.orphan_ids.discard(orphan.block_id)
+                self.pruned_blocks[orphan.block_id] = orphan.depth
+                parents.append(orphan.block_id)
 
-        
     def create_block(self,time):
         """
         Function to create a block
         """
         if self.hashing_power == 0:
             return
-        transaction_copy = []
         if self.is_selfish:
             coinbase_txn = Transaction(coinbase_id,self.id,mining_fee,time)
-            transaction_copy.append(coinbase_txn)
+            transaction_copy = [coinbase_txn]
         else:
-            transaction_copy = self.transactions_list.copy()
-            parent_block = self.BlockChain.find_block(self.BlockChain.longest_chain_id)
-            while parent_block.block_id != -1 and parent_block.block_id != 0:
-                for i in parent_block.transactions_list:
-                    if i in transaction_copy:
-                        transaction_copy.remove(i) # remove the transactions already in the blockchain
-                parent_block = parent_block.parent
-            
+            # bring the mempool up to the current longest chain, only the blocks that changed are visited
+            self.mempool.update_tip(self.BlockChain.find_block(self.BlockChain.longest_chain_id))
+
             # transaction_copy has the transactions that are not in the longest chain in the blockchain
-            
-                
-            if len(transaction_copy) > max_no_of_transactions:
-                transaction_copy = transaction_copy[:max_no_of_transactions]
-            
+            transaction_copy = self.mempool.get_transactions(max_no_of_transactions)
+
             # create the coinbase transaction and add it to the list of transactions
             coinbase_txn = Transaction(coinbase_id,self.id,mining_fee,time)
             transaction_copy.append(coinbase_txn)
 
         # update the peer balances after the transactions in the block
-        peer_balances = self.BlockChain.find_block(self.BlockChain.longest_chain_id).peer_balances.copy()
+        # and leave out the transactions whose sender cannot pay for them
+        parent_balances = self.BlockChain.find_block(self.BlockChain.longest_chain_id).peer_balances
+        peer_balances = parent_balances.begin()
+        block_transactions = []
         for i in transaction_copy:
             if i.sender == coinbase_id:
                 peer_balances[self.id] += mining_fee
             else:
                 if peer_balances[i.sender] <  i.amount:
-                    transaction_copy.remove(i)
-                else:    
-                    peer_balances[i.sender] -= i.amount
-                    peer_balances[i.reciever] += i.amount
+                    continue
+                peer_balances[i.sender] -= i.amount
+                peer_balances[i.reciever] += i.amount
+            block_transactions.append(i)
+        transaction_copy = block_transactions
+        peer_balances = parent_balances.apply(peer_balances)
 
         # create the block
-        hashing_time = random.expovariate(self.hashing_power / mining_time)
+        if self.mining_stream is not None:
+            hashing_time = self.mining_stream.expovariate(self.hashing_power / mining_time)
+        else:
+            hashing_time = random.expovariate(self.hashing_power / mining_time)
         new_block = Block(transaction_copy,self.BlockChain.longest_chain_id,self.id,time+hashing_time,peer_balances)
         
         # schedule the mining of the block
@@ -461,9 +1301,13 @@ class Peer:
         """
         Function to forward a block
         """
-        prop_delay = N.propgation_delay[self.id][reciever_id]
-        transmission_delay = (block.block_size/N.link_speeds[self.id][reciever_id])
-        event = Event(time+prop_delay+transmission_delay,self.id,reciever_id,block,RECIEVE_BLOCK)
+        prop_delay = N.propagation_delay(self.id,reciever_id)
+        if compact_blocks:
+            transmission_delay = (compact_block_size(block)/N.link_speed(self.id,reciever_id))
+            event = Event(time+prop_delay+transmission_delay,self.id,reciever_id,block,RECIEVE_CMPCT_BLOCK)
+        else:
+            transmission_delay = (block.block_size/N.link_speed(self.id,reciever_id))
+            event = Event(time+prop_delay+transmission_delay,self.id,reciever_id,block,RECIEVE_BLOCK)
         events.add_event(event)
     
     def successful_block(self,time,block,previous_longest_chain):
@@ -486,7 +1330,12 @@ class Peer:
                 tot_blks_adversary2 += 1
             ############################################################################################################
 
-            if self.BlockChain.add_block(block):
+            # the block was built on top of valid balances, so the other peers do not need to validate it again
+            validation_cache[block.block_id] = (True,block.peer_balances)
+            if trace is not None:
+                depth = self.BlockChain.find_block(block.prev_block_id).depth + 1
+                trace.write(TRACE_BLOCK_MINED,time,self.id,block.block_id,block.prev_block_id,depth,len(block.transactions_list))
+            if self.add_block(block,time):
                 event = Event(time,self.id,None,None,CREATE_BLOCK)
                 events.add_event(event)
             self.no_of_created_blocks += 1
@@ -494,23 +1343,23 @@ class Peer:
                 self.selfish_blocks.append(block)
                 self.lead +=1
             else:
-                for i in self.neighbours:
-                # forward the block to the neighbours
-                    queuing_delay = random.expovariate(N.link_speeds[self.id][i]/queing_delay_constant)
-                    event = Event(time+queuing_delay,self.id,i,block,FORWARD_BLOCK)
-                    events.add_event(event)
+                self.relay_block(block,time) # forward the block to the neighbours
+            if finality_depth is not None and tot_mined_blks % finality_depth == 0:
+                N.prune_blocks()
     
+    def update_honest_chain(self,block):
+        """
+        Function to update the longest honest chain with a block added to the blockchain or released by the selfish miner
+        """
+        if block.depth > self.honest_depth:
+            self.honest_depth = block.depth
+            self.honest_tip_id = block.block_id
+
     def longest_chain(self):
         """
         return the length of the longest honest chain
         """
-        k = 0
-        for i in self.BlockChain.seen_blocks:
-            if i in self.selfish_blocks:
-                continue
-            if i.depth > k:
-                k = i.depth
-        return k
+        return self.honest_depth
                 
     
     def validate_block(self,block):
@@ -518,30 +1367,188 @@ class Peer:
         Function to validate a recieved block
         """
         
+        # whether a block is valid depends only on the block and its parent,
+        # so the first peer to validate a block stores the result for every other peer
+        cached = validation_cache.get(block.block_id)
+        if cached is not None:
+            block.peer_balances = cached[1]
+            return cached[0]
+
         #  balances are stored near the peer, and these balances are used to validate the block
-        balance = self.BlockChain.find_block(block.prev_block_id).peer_balances.copy()
+        parent_balances = self.BlockChain.find_block(block.prev_block_id).peer_balances
+        balance = parent_balances.begin()
         for i in block.transactions_list:
             if i.sender == coinbase_id:
                 balance[block.creator_id] += mining_fee
             else:
                 balance[i.sender] -= i.amount
                 balance[i.reciever] += i.amount
-        block.peer_balances = balance
-        for i in range(no_of_peers):
-            if balance[i] < 0:
-                return False
-        return True
+        block.peer_balances = parent_balances.apply(balance)
+        # the balances before the block are valid, so only the changed balances need to be checked
+        is_valid = True
+        for i in balance.values():
+            if i < 0:
+                is_valid = False
+                break
+        validation_cache[block.block_id] = (is_valid,block.peer_balances)
+        return is_valid
     
     def release_all_selfish_blks(self,time):
         """
         release all the selfish blocks to the neighbours
         """
         for j in self.selfish_blocks:
-            for i in self.neighbours:
-                queuing_delay = random.expovariate(N.link_speeds[self.id][i]/queing_delay_constant)
-                event = Event(time+queuing_delay,self.id,i,j,FORWARD_BLOCK)
-                events.add_event(event)
-        self.selfish_blocks = []
+            self.relay_block(j,time)
+            self.update_honest_chain(j)
+        self.selfish_blocks.clear()
+
+
+class DenseLinks:
+
+    """
+    DenseLinks class to store the propagation delay and link speed between every pair of peers in matrices
+    """
+
+    def __init__(self,propgation_delay,link_speeds):
+        """
+        Constructor to initialize the links
+        Args:
+        propgation_delay: propagation delay between every pair of peers
+        link_speeds: link speed between every pair of peers
+        """
+        self.propgation_delay = propgation_delay
+        self.link_speeds = link_speeds
+
+    def propagation_delay(self,i,j):
+        return self.propgation_delay[i][j]
+
+    def link_speed(self,i,j):
+        return self.link_speeds[i][j]
+
+
+class SparseLinks:
+
+    """
+    SparseLinks class to store the propagation delay and link speed of the links of the network only, in compact arrays
+    The links of peer i are the slots offsets[i] to offsets[i+1]-1 of the arrays, sorted by neighbour, so the slot of
+    a link is found by a binary search and the memory is proportional to the number of links and not to the square of
+    the number of peers
+    """
+
+    def __init__(self,neighbours,delays,speeds):
+        """
+        Constructor to initialize the links
+        Args:
+        neighbours: list of neighbours of every peer
+        delays: propagation delay of every link, in the order of the neighbours of every peer
+        speeds: link speed of every link, in the same order
+        """
+        self.no_of_peers = len(neighbours)
+        self.offsets = array('q',[0]) # first slot of every peer
+        self.targets = array('q') # neighbour of every slot
+        self.delays = array('d')
+        self.speeds = array('d')
+        start = 0
+        for i in neighbours:
+            for _,slot in sorted((j,start + k) for k,j in enumerate(i)):
+                self.targets.append(i[slot - start])
+                self.delays.append(delays[slot])
+                self.speeds.append(speeds[slot])
+            start += len(i)
+            self.offsets.append(start)
+
+    def propagation_delay(self,i,j):
+        offsets = self.offsets
+        return self.delays[bisect_left(self.targets,j,offsets[i],offsets[i+1])]
+
+    def link_speed(self,i,j):
+        offsets = self.offsets
+        return self.speeds[bisect_left(self.targets,j,offsets[i],offsets[i+1])]
+
+
+class CoordinateLinks:
+
+    """
+    CoordinateLinks class to compute the propagation delay of a link from the positions of its peers instead of storing it
+    Every peer has a random position on a sphere (the earth) and an access delay, and the delay of a link is
+    min_delay + distance_delay * (angle between the peers / pi) + the access delays of both peers + a jitter of the link.
+    The delay is the same in both directions, between min_delay and min_delay + distance_delay + 2 * max_access_delay
+    + max_jitter (10 ms to 500 ms), and the memory is proportional to the number of peers
+    """
+
+    min_delay = 0.010
+    distance_delay = 0.300
+    max_access_delay = 0.050
+    max_jitter = 0.090
+
+    def __init__(self,slow_list):
+        """
+        Constructor to place the peers
+        Args:
+        slow_list: 1 for the slow peers and 0 for the other peers
+        """
+        self.no_of_peers = len(slow_list)
+        self.slow_list = slow_list
+        # uniformly distributed points on the unit sphere
+        self.x = array('d')
+        self.y = array('d')
+        self.z = array('d')
+        for _ in range(self.no_of_peers):
+            z = random.uniform(-1,1)
+            longitude = random.uniform(0,2*math.pi)
+            r = math.sqrt(1 - z*z)
+            self.x.append(r * math.cos(longitude))
+            self.y.append(r * math.sin(longitude))
+            self.z.append(z)
+        self.access_delay = array('d',[random.uniform(0,self.max_access_delay) for _ in range(self.no_of_peers)])
+        self.salt = random.getrandbits(64) # makes the jitters of every network different
+
+    def jitter(self,i,j):
+        """
+        Function to get the jitter of the link between peers i and j
+        The jitter is a hash of the link (splitmix64), so it is the same every time and needs no memory
+        """
+        if i > j:
+            i,j = j,i
+        h = (i * self.no_of_peers + j + self.salt + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        h ^= h >> 31
+        return (h >> 11) / 9007199254740992 * self.max_jitter # 53 bits as a fraction of 2**53
+
+    def propagation_delay(self,i,j):
+        cos_angle = self.x[i]*self.x[j] + self.y[i]*self.y[j] + self.z[i]*self.z[j]
+        angle = math.acos(max(-1.0,min(1.0,cos_angle)))
+        return self.min_delay + self.distance_delay * angle / math.pi + (self.access_delay[i] + self.access_delay[j]) + self.jitter(i,j)
+
+    def link_speed(self,i,j):
+        return slow_link_speed if self.slow_list[i] or self.slow_list[j] else fast_link_speed
+
+
+class Topology:
+
+    """
+    Topology class to represent a snapshot of the peer to peer network: the slow peers, the adversaries,
+    the neighbours of every peer and the links (propagation delays and link speeds).
+    A topology is never modified by a simulation, so one snapshot can be shared by many simulations
+    """
+
+    def __init__(self,slow_list,adversary1_id,adversary2_id,neighbours,links):
+        """
+        Constructor to initialize the topology
+        Args:
+        slow_list: 1 for the slow peers and 0 for the other peers
+        adversary1_id: id of the first adversary
+        adversary2_id: id of the second adversary
+        neighbours: list of neighbours of every peer
+        links: DenseLinks, SparseLinks or CoordinateLinks of the network
+        """
+        self.no_of_peers = len(slow_list)
+        self.slow_list = slow_list
+        self.adversary1_id = adversary1_id
+        self.adversary2_id = adversary2_id
+        self.neighbours = neighbours
+        self.links = links
 
 
 class Network:
@@ -550,7 +1557,7 @@ class Network:
     Network class to represent the network
     """
 
-    def __init__(self,no_of_peers,zeta1,zeta2,tmean):
+    def __init__(self,no_of_peers,zeta1,zeta2,tmean,topology=None):
         """
         Constructor to initialize the network
         Args:
@@ -558,6 +1565,7 @@ class Network:
         slow: percentage of slow peers
         lowCPU: percentage of lowCPU peers
         tmean: mean time between transactions
+        topology: topology to reuse instead of generating a new one
         """
         self.peers = [] # list of peers
         self.zeta1_power = float(zeta1)/float(100)
@@ -565,8 +1573,24 @@ class Network:
         self.tmean = tmean
         self.connected_graph = False # whether the network is connected
         self.no_of_peers = no_of_peers
+        self.final_depth = 0 # depth of the final block of the last pruning
+        self.final_chain = [] # blocks of the chain from depth 1 to the final block (excluded), which only keep their header
+        if finality_depth is not None and finality_depth < 1:
+            raise ValueError("The finality depth must be at least 1")
+        global adversary1_id, adversary2_id
+        if topology is not None:
+            if topology.no_of_peers != no_of_peers:
+                raise ValueError(f"The topology has {topology.no_of_peers} peers, not {no_of_peers}")
+            self.use_topology(topology)
+            return
+
         no_of_slow = int(no_of_peers/2) # number of slow peers
-        self.propgation_delay = [[random.uniform(0.010,0.500) for _ in range(no_of_peers)] for _ in range(no_of_peers)]
+        if topology_builder not in ("dense","sparse"):
+            raise ValueError(f"Unknown topology builder: {topology_builder}")
+        if latency_model not in ("random","coordinates"):
+            raise ValueError(f"Unknown latency model: {latency_model}")
+        if topology_builder == "dense" and latency_model == "random":
+            propgation_delay = [[random.uniform(0.010,0.500) for _ in range(no_of_peers)] for _ in range(no_of_peers)]
 
         # create the peers and assign the slow and lowCPU attributes
         slow_list = [1] * no_of_slow + [0] * (no_of_peers - no_of_slow)
@@ -574,7 +1598,6 @@ class Network:
 
         # assign the selfish nodes
         selfish_nodes = random.sample(range(no_of_peers),2)
-        global adversary1_id, adversary2_id
         adversary1_id, adversary2_id = selfish_nodes
 
         # make sure that the selfish nodes are not slow
@@ -593,23 +1616,139 @@ class Network:
 
         print("Selfish nodes: ",selfish_nodes)
 
-
-        
-        honest_mining_power = float(100-zeta1-zeta2)/float(100*(self.no_of_peers-2))
-        for i in range(no_of_peers):
-            if i == adversary1_id:
-                self.peers.append(Peer(i,slow_list[i],self.zeta1_power,True))
-            elif i == adversary2_id:
-                self.peers.append(Peer(i,slow_list[i],self.zeta2_power,True))
-            else:
-                self.peers.append(Peer(i,slow_list[i],honest_mining_power))
+        self.slow_list = slow_list
+        self.create_peers()
+        if latency_model == "coordinates":
+            self.links = CoordinateLinks(slow_list)
+        if topology_builder == "sparse":
+            self.create_sparse_network()
+            return
+        if latency_model == "coordinates":
+            return
         
         # create the link speeds between the peers
-        self.link_speeds = [[fast_link_speed for _ in range(no_of_peers)] for _ in range(no_of_peers)] # 100 Mbps in kbps
+        link_speeds = [[fast_link_speed for _ in range(no_of_peers)] for _ in range(no_of_peers)] # 100 Mbps in kbps
         for i in range(no_of_peers):
             for j in range(no_of_peers):
                 if self.peers[i].is_slow or self.peers[j].is_slow:
-                    self.link_speeds[i][j] =  slow_link_speed # 5 Mbps in kbps
+                    link_speeds[i][j] =  slow_link_speed # 5 Mbps in kbps
+        self.links = DenseLinks(propgation_delay,link_speeds)
+
+    def propagation_delay(self,i,j):
+        """
+        Function to get the propagation delay of the link from peer i to peer j
+        """
+        return self.links.propagation_delay(i,j)
+
+    def link_speed(self,i,j):
+        """
+        Function to get the speed of the link from peer i to peer j
+        """
+        return self.links.link_speed(i,j)
+
+    def create_peers(self):
+        """
+        Function to create the peers and assign their hashing power
+        """
+        honest_mining_power = float(1-self.zeta1_power-self.zeta2_power)/float(self.no_of_peers-2)
+        for i in range(self.no_of_peers):
+            if i == adversary1_id:
+                self.peers.append(Peer(i,self.slow_list[i],self.zeta1_power,True))
+            elif i == adversary2_id:
+                self.peers.append(Peer(i,self.slow_list[i],self.zeta2_power,True))
+            else:
+                self.peers.append(Peer(i,self.slow_list[i],honest_mining_power))
+
+    def use_topology(self,topology):
+        """
+        Function to build the network from a topology snapshot instead of generating it
+        The delays, link speeds and neighbour lists of the snapshot are shared, not copied
+        """
+        global adversary1_id, adversary2_id
+        adversary1_id, adversary2_id = topology.adversary1_id, topology.adversary2_id
+        self.slow_list = topology.slow_list
+        self.links = topology.links
+        self.create_peers()
+        for peer in self.peers:
+            peer.neighbours = topology.neighbours[peer.id]
+        self.connected_graph = True
+
+    def relink_blocks(self):
+        """
+        Function to restore the parent and children links of the blocks, which are not saved in checkpoints
+        """
+        for peer in self.peers:
+            for block in peer.BlockChain.block_index.values():
+                block.children = []
+        headers = self.final_chain # the blocks before the final block are only in final_chain
+        for parent,block in zip([self.peers[0].BlockChain.root] + headers,headers):
+            block.parent = parent
+        for peer in self.peers:
+            chain = peer.BlockChain
+            for block in islice(chain.block_index.values(),1,None): # the blocks are stored after their parent
+                parent = chain.find_block(block.prev_block_id)
+                if parent is None: # the final block, its parent left the blockchain
+                    block.parent = headers[-1]
+                    continue
+                parent.children.append(block)
+                block.parent = parent
+
+    def common_prefix(self):
+        """
+        Function to get the last block of the chain all the peers agree on, the common ancestor of their longest chains
+        """
+        return common_prefix(peer.BlockChain.find_block(peer.BlockChain.longest_chain_id) for peer in self.peers)
+
+    def prune_blocks(self):
+        """
+        Function to prune the blockchains of the peers, called every finality_depth mined blocks
+        The final block is finality_depth blocks below the last block of the chain all the peers agree on.
+        The stale branches forking off below it are removed from the blockchains, and the blocks before it leave
+        the blockchains and keep only their header (id, parent, creator, time, depth): their transactions and
+        balances are dropped. The peers remember the pruned blocks they have seen until they are finality_depth
+        blocks below the final block, the blocks arriving later on a stale branch are dropped without being forwarded
+        """
+        prefix = self.common_prefix()
+        final_depth = prefix.depth - finality_depth
+        if final_depth <= self.final_depth:
+            withheld = sum(len(peer.selfish_blocks) for peer in self.peers)
+            if withheld > finality_depth:
+                warnings.warn(f"The blocks cannot be pruned while the selfish miners withhold {withheld} blocks, the final block stays at depth {self.final_depth}",RuntimeWarning)
+            return
+        final_block = prefix.ancestor(final_depth)
+        pruned = {} # block id -> block removed from a blockchain
+        for peer in self.peers:
+            for block in peer.BlockChain.prune(final_block):
+                pruned[block.block_id] = block
+                peer.pruned_blocks[block.block_id] = block.depth
+        for block in pruned.values():
+            validation_cache.pop(block.block_id,None)
+            if block.parent is not None and block.parent.block_id not in pruned:
+                block.parent.children = [i for i in block.parent.children if i.block_id not in pruned]
+        for peer in self.peers:
+            # the blocks waiting for the same block are on the same branch
+            for parent_id in [i for i,orphans in peer.orphan_blocks.items() if not peer.BlockChain.extends_final_block(orphans[0])]:
+                peer.drop_orphans(parent_id)
+            peer.pruned_blocks = {i: depth for i,depth in peer.pruned_blocks.items() if depth + finality_depth > final_depth}
+
+        # the blocks before the final block keep only their header, the genesis block is kept
+        headers = []
+        block = final_block.parent
+        while block is not None and block.depth > 0 and block.depth >= self.final_depth:
+            block.transactions_list = None
+            block.peer_balances = None
+            block.children = []
+            validation_cache.pop(block.block_id,None)
+            headers.append(block)
+            block = block.parent
+        self.final_chain.extend(reversed(headers))
+        self.final_depth = final_depth
+
+    def topology(self):
+        """
+        Function to take a snapshot of the topology of the network
+        """
+        return Topology(self.slow_list,adversary1_id,adversary2_id,[peer.neighbours for peer in self.peers],self.links)
 
     def create_adjacency_list(self):
 
@@ -638,15 +1777,101 @@ class Network:
             
             self.connected_graph=self.check_connected_network()
 
+    def create_sparse_network(self):
+        """
+        Function to create a connected network in which every peer has 3 to 6 neighbours, and its links
+        Unlike create_adjacency_list the network is connected by construction, see sparse_neighbours
+        """
+        neighbours = None
+        while neighbours is None:
+            neighbours = self.sparse_neighbours()
+        for i in range(self.no_of_peers):
+            self.peers[i].neighbours = neighbours[i]
+        self.connected_graph = True
+        if latency_model == "coordinates":
+            return # the delays are computed by CoordinateLinks
+        delays = []
+        speeds = []
+        for i in range(self.no_of_peers):
+            for j in neighbours[i]:
+                delays.append(random.uniform(0.010,0.500))
+                speeds.append(slow_link_speed if self.slow_list[i] or self.slow_list[j] else fast_link_speed)
+        self.links = SparseLinks(neighbours,delays,speeds)
+
+    def sparse_neighbours(self):
+        """
+        Function to pick the neighbours of every peer of a sparse network
+        The peers are joined into a random tree, and then every peer is linked to random peers until it has
+        the number of neighbours it picked (3 to 6). A peer that cannot find a peer with room for another
+        neighbour takes the place of a random link u-v with two links u-peer and peer-v, which keeps the
+        network connected. Networks of at most 7 peers are complete
+        Returns the list of neighbours of every peer, or None in the rare case a peer could not get 3 neighbours
+        """
+        n = self.no_of_peers
+        if n <= 7:
+            return [[j for j in range(n) if j != i] for i in range(n)]
+        neighbours = [[] for _ in range(n)]
+        open_peers = [] # peers with less than 6 neighbours
+        position = {} # peer id -> position in open_peers
+
+        def link(i,j):
+            neighbours[i].append(j)
+            neighbours[j].append(i)
+            for k in (i,j):
+                if len(neighbours[k]) == 6:
+                    # remove k from open_peers by moving the last open peer to its place
+                    last = open_peers.pop()
+                    if last != k:
+                        open_peers[position[k]] = last
+                        position[last] = position[k]
+                    del position[k]
+
+        # random tree: every peer is linked to a random earlier peer that has room for another neighbour
+        order = list(range(n))
+        random.shuffle(order)
+        for k,i in enumerate(order):
+            position[i] = len(open_peers)
+            open_peers.append(i)
+            if k > 0:
+                j = random.choice(open_peers)
+                while j == i:
+                    j = random.choice(open_peers)
+                link(i,j)
+
+        # more links until every peer has the number of neighbours it picked
+        for i in order:
+            wanted = random.randint(3,6)
+            tries = 0
+            while len(neighbours[i]) < wanted and tries < 20:
+                j = random.choice(open_peers)
+                if j == i or j in neighbours[i]:
+                    tries += 1
+                    continue
+                link(i,j)
+            tries = 0
+            while len(neighbours[i]) < 3:
+                # i has at most 2 neighbours, so it has room for u and v
+                u = random.randrange(n)
+                v = random.choice(neighbours[u])
+                if i in (u,v) or u in neighbours[i] or v in neighbours[i]:
+                    tries += 1
+                    if tries > 100 * n:
+                        return None
+                    continue
+                neighbours[u][neighbours[u].index(v)] = i
+                neighbours[v][neighbours[v].index(u)] = i
+                neighbours[i] += [u,v]
+        return neighbours
+
     def check_connected_network(self):
         """
         Function to check if the network is connected
         """
         visited = [0]*no_of_peers
-        q = [0]
+        q = deque([0])
         visited[0] = 1
         while len(q) != 0:
-            v = q.pop(0)
+            v = q.popleft()
             for i in self.peers[v].neighbours:
                 if visited[i] == 0:
                     visited[i] = 1
@@ -662,11 +1887,14 @@ class Network:
 
         for i in range(no_of_peers):
 
-            reciever = random.sample(range(self.no_of_peers),1)[0]
-            while reciever == i:
+            if self.peers[i].transaction_stream is not None:
+                var_time,reciever,amount = self.peers[i].transaction_stream.transaction(i,self.no_of_peers)
+            else:
                 reciever = random.sample(range(self.no_of_peers),1)[0]
-            amount = random.randint(1,3)
-            var_time = random.expovariate(1 / tmean)
+                while reciever == i:
+                    reciever = random.sample(range(self.no_of_peers),1)[0]
+                amount = random.randint(1,3)
+                var_time = random.expovariate(1 / tmean)
             event = Event(var_time,i,reciever,Transaction(i,reciever,amount,var_time),CREATE_TXN)
             events.add_event(event)
     
@@ -679,9 +1907,330 @@ class Network:
             events.add_event(event)
 
 
+############################################################################################################
+# Trace
+
+class TraceWriter:
+
+    """
+    TraceWriter class to stream the trace of a simulation to a binary file while it runs
+    The file has a header of TRACE_HEADER_SIZE bytes followed by fixed-width little-endian records
+    (time, item id, parent id, peer id, depth, aux, kind), which trace_analysis.py reads as a memory-mapped array.
+    Records by kind:
+    TRACE_TXN_CREATED: peer creates transaction item for reciever aux
+    TRACE_TXN_RECIEVED: peer sees transaction item for the first time, from neighbour aux
+    TRACE_BLOCK_MINED: peer mines block item on parent at depth, with aux transactions
+    TRACE_BLOCK_ADDED: peer adds block item, created by aux, on parent at depth to its blockchain
+    TRACE_TIP_CHANGED: the longest chain of peer now ends at block item, created by aux, on parent at depth
+    """
+
+    header = struct.Struct("<8siiiiiq") # magic, version, record size, number of peers, adversary1 id, adversary2 id, number of records
+    record = struct.Struct("<dqqiiii")
+    magic = b"BCTRACE1"
+    version = 1
+
+    def __init__(self,path,transactions=True,buffer_size=1<<20):
+        """
+        Constructor to initialize the trace
+        Args:
+        path: file of the trace, overwritten if it exists
+        transactions: whether to trace the transactions, which are most of the records
+        buffer_size: number of bytes buffered before they are written to the file
+        """
+        self.path = path
+        self.transactions = transactions
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.count = 0 # number of records
+        self.network = (-1,-1,-1) # number of peers, adversary1 id, adversary2 id
+        self.file = open(path,"wb")
+        self.write_header()
+
+    def set_network(self,no_of_peers,adversary1_id,adversary2_id):
+        """
+        Function to set the network described in the header
+        """
+        self.network = (no_of_peers,adversary1_id,adversary2_id)
+
+    def write(self,kind,time,peer_id,item_id,parent_id=-1,depth=0,aux=-1):
+        """
+        Function to add a record to the trace
+        """
+        self.buffer += self.record.pack(time,item_id,parent_id,peer_id,depth,aux,kind)
+        self.count += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_header(self):
+        header = self.header.pack(self.magic,self.version,self.record.size,*self.network,self.count)
+        self.file.write(header + bytes(TRACE_HEADER_SIZE - len(header)))
+
+    def flush(self):
+        """
+        Function to write the buffered records, and the header with the new number of records
+        """
+        self.file.write(self.buffer)
+        self.buffer.clear()
+        self.file.seek(0)
+        self.write_header()
+        self.file.seek(0,os.SEEK_END)
+        self.file.flush()
+
+    def close(self):
+        """
+        Function to write the buffered records and close the file
+        """
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __getstate__(self):
+        # a checkpoint only keeps where the trace ends, see reopen
+        if self.file is not None:
+            self.flush()
+        return {"path": self.path,"transactions": self.transactions,"buffer_size": self.buffer_size,"count": self.count,"network": self.network}
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.buffer = bytearray()
+        self.file = None
+
+    def reopen(self):
+        """
+        Function to continue a trace loaded from a checkpoint
+        The records written after the checkpoint are removed, so the trace matches the continued run
+        """
+        self.file = open(self.path,"r+b")
+        self.file.truncate(TRACE_HEADER_SIZE + self.count * self.record.size)
+        self.flush()
+
+
+############################################################################################################
+# Profiling
+
+class EventProfiler:
+
+    """
+    EventProfiler class to measure where the time of a simulation goes
+    It counts the processed events by type and measures the time of their handlers, with the percentiles taken
+    from a histogram with 16 buckets per power of two (so they are exact to about 5%). Every sample_interval
+    simulated seconds it samples the size of the event queue, the blocks per peer and the mempool sizes, and
+    every report_interval events it prints a report line
+    """
+
+    zero_bucket = -1 << 20 # histogram bucket of the handlers that took no measurable time, below every other bucket
+    sample_fields = ["time","queued_events","blocks_per_peer_mean","blocks_per_peer_max","mempool_size_mean","mempool_size_max"]
+
+    def __init__(self,report_interval=None,sample_interval=1.0):
+        """
+        Constructor to initialize the profiler
+        Args:
+        report_interval: number of events between two report lines, None for no reports
+        sample_interval: simulated seconds between two samples of the queue, blockchain and mempool sizes
+        """
+        self.report_interval = report_interval
+        self.sample_interval = sample_interval
+        self.counts = dict.fromkeys(EVENT_NAMES,0) # event type -> number of events processed
+        self.times = dict.fromkeys(EVENT_NAMES,0.0) # event type -> total time of the handlers (in seconds)
+        self.histograms = {i: {} for i in EVENT_NAMES} # event type -> histogram bucket -> number of events
+        self.no_of_events = 0
+        self.no_of_drain_events = 0 # number of events processed while draining
+        self.wall_time = 0 # time spent in the loops of the simulation (in seconds)
+        self.loop_start = None # time the current loop started
+        self.samples = [] # tuples with the sample_fields
+        self.next_sample_time = 0 # simulated time of the next sample
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["loop_start"] = None
+        return state
+
+    def begin(self):
+        """
+        Function to mark the start of a loop processing events
+        """
+        self.loop_start = perf_counter()
+
+    def end(self):
+        """
+        Function to mark the end of a loop processing events
+        """
+        if self.loop_start is not None:
+            self.wall_time += perf_counter() - self.loop_start
+            self.loop_start = None
+
+    def process(self,event,draining=False):
+        """
+        Function to process an event with process_event() and measure it
+        """
+        if event.scheduled_time >= self.next_sample_time:
+            self.sample(event.scheduled_time)
+        start = perf_counter()
+        process_event(event,draining)
+        elapsed = perf_counter() - start
+        self.counts[event.type] += 1
+        self.times[event.type] += elapsed
+        if elapsed > 0:
+            mantissa,exponent = math.frexp(elapsed)
+            bucket = exponent * 16 + int(mantissa * 32) - 16 # 16 buckets between 2**(exponent-1) and 2**exponent
+        else:
+            bucket = self.zero_bucket # too fast for the clock
+        histogram = self.histograms[event.type]
+        histogram[bucket] = histogram.get(bucket,0) + 1
+        self.no_of_events += 1
+        if draining:
+            self.no_of_drain_events += 1
+        if self.report_interval is not None and self.no_of_events % self.report_interval == 0:
+            self.report(event.scheduled_time)
+
+    def sample(self,time_now):
+        """
+        Function to sample the size of the event queue, the blocks per peer and the mempool sizes
+        """
+        blocks = [len(peer.BlockChain.block_index) for peer in N.peers]
+        mempools = [len(peer.mempool.unconfirmed) for peer in N.peers]
+        self.samples.append((time_now,len(events),sum(blocks)/len(blocks),max(blocks),sum(mempools)/len(mempools),max(mempools)))
+        self.next_sample_time = time_now + self.sample_interval
+
+    def percentile(self,event_type,q):
+        """
+        Function to get the q-th percentile (0 to 100) of the handler times of an event type, None if there are no events
+        Returns the upper bound of the histogram bucket of the percentile
+        """
+        rank = q / 100 * self.counts[event_type]
+        seen = 0
+        for bucket in sorted(self.histograms[event_type]):
+            seen += self.histograms[event_type][bucket]
+            if seen >= rank:
+                if bucket <= self.zero_bucket:
+                    return 0.0
+                exponent,step = divmod(bucket,16)
+                return math.ldexp((step + 17) / 32,exponent)
+        return None
+
+    def report(self,time_now):
+        """
+        Function to print a report line: the events processed so far and the event types taking the most time
+        """
+        wall_time = self.wall_time + (perf_counter() - self.loop_start if self.loop_start is not None else 0)
+        handler_time = sum(self.times.values()) or 1
+        top = sorted(self.times,key=self.times.get,reverse=True)[:3]
+        shares = ", ".join(f"{EVENT_NAMES[i]} {100 * self.times[i] / handler_time:.0f}%" for i in top if self.counts[i])
+        print(f"events {self.no_of_events}, {self.no_of_events / wall_time if wall_time else 0:.0f} events/s, simulated time {time_now:.3f} s, queued events {len(events)}, time in {shares}")
+
+    def summary(self):
+        """
+        Function to get the measurements as a dictionary that can be written as JSON
+        """
+        event_types = {}
+        for event_type,name in EVENT_NAMES.items():
+            if self.counts[event_type] == 0:
+                continue
+            event_types[name] = {
+                "count": self.counts[event_type],
+                "total_time": self.times[event_type],
+                "mean_time": self.times[event_type] / self.counts[event_type],
+                "p50_time": self.percentile(event_type,50),
+                "p90_time": self.percentile(event_type,90),
+                "p99_time": self.percentile(event_type,99),
+            }
+        return {
+            "events": self.no_of_events,
+            "drain_events": self.no_of_drain_events,
+            "wall_time": self.wall_time,
+            "handler_time": sum(self.times.values()),
+            "events_per_second": self.no_of_events / self.wall_time if self.wall_time else 0,
+            "event_types": event_types,
+            "samples": [dict(zip(self.sample_fields,i)) for i in self.samples],
+        }
+
+    def write(self,path):
+        """
+        Function to write the summary to a JSON file
+        """
+        with open(path,'w') as f:
+            json.dump(self.summary(),f,indent=2)
+
 ############################################################################################################
 # Analysis
-def analysis():
+
+def output_directory():
+    """
+    Function to get the output directory of the current simulation
+    """
+    return f"output_{no_of_peers}_{zeta1}_{zeta2}_{tmean}_{mining_time}_{max_iterations}"
+
+def blockchain_picture(peer):
+    """
+    Function to describe the image of the blockchain of a peer
+    Returns a list of (block id, label, color, parent block id) for every block drawn, parents first
+    With render_last_depths, and with finality_depth, the blocks before the last depths or before the final block
+    are drawn as one node with id -1
+    """
+    chain = peer.BlockChain
+    min_depth = 0 if render_last_depths is None else max(0,chain.max_depth - render_last_depths + 1)
+    min_depth = max(min_depth,chain.final_depth) # the blocks before the final block left the blockchain
+    picture = []
+    if min_depth > 0:
+        picture.append((-1,f"Blocks at depth 0 to {min_depth - 1}\n",'gray',None))
+    for block in chain.block_index.values():
+        if block.depth < min_depth:
+            continue
+        color = 'black'
+        if block.creator_id == adversary1_id:
+            color = 'red'
+        if block.creator_id == adversary2_id:
+            color = 'blue'
+        if block.block_id == chain.longest_chain_id:
+            color = 'green'
+        if block.parent is None:
+            parent_id = None
+        elif block.depth == min_depth:
+            parent_id = -1
+        else:
+            parent_id = block.parent.block_id
+        label = f"Block ID: {block.block_id}\nMiner ID: {block.creator_id}\nTime: {block.time}\n Depth: {block.depth}, No of trans: {len(block.transactions_list) if block.transactions_list is not None else 'pruned'}\n"
+        picture.append((block.block_id,label,color,parent_id))
+    return picture
+
+def render_picture(picture,path):
+    """
+    Function to render the image of a blockchain described by blockchain_picture() to a file
+    """
+    nodes = {}
+    for block_id,label,color,parent_id in picture:
+        nodes[block_id] = Node(label,color=color)
+        if parent_id is not None:
+            nodes[block_id].parent = nodes[parent_id]
+    DotExporter(nodes[picture[0][0]], nodeattrfunc=lambda node: f'color="{node.color}"').to_picture(path)
+
+def render_blockchains():
+    """
+    Function to render the blockchain of the peers (all of them, or render_peers) as images in the output directory
+    Peers with the same blocks and the same longest chain have the same image, so it is rendered once and copied.
+    The images are rendered by a pool of threads, since most of the work is done by the Graphviz processes
+    """
+    renders = {} # (block ids, id of the last block of the longest chain) -> (picture, paths of the image)
+    for i in (range(no_of_peers) if render_peers is None else render_peers):
+        chain = N.peers[i].BlockChain
+        key = (frozenset(chain.block_index),chain.longest_chain_id)
+        if key not in renders:
+            renders[key] = (blockchain_picture(N.peers[i]),[])
+        renders[key][1].append(f"{output_directory()}/Peer_{i}_BlockChain_Image.png")
+
+    with ThreadPoolExecutor(render_workers) as pool:
+        list(pool.map(render_picture,[picture for picture,_ in renders.values()],[paths[0] for _,paths in renders.values()]))
+    for _,paths in renders.values():
+        for path in paths[1:]:
+            shutil.copyfile(paths[0],path)
+
+def analysis(write_output=True):
+    """
+    Function to analyse the simulation
+    Returns a dictionary with the metrics of the simulation, and if write_output is True
+    also writes Analysis.txt, the blockchain images and the peer network graph to the output directory
+    """
     global blks_in_chain_adversary1
     global blks_in_chain_adversary2
     k=0
@@ -698,18 +2247,51 @@ def analysis():
         if blk.creator_id == adversary2_id:
             blks_in_chain_adversary2 += 1
         blk = blk.parent
+
+    tot_blks_in_chain = N.peers[0].BlockChain.max_depth
+    metrics = {
+        "no_of_peers": no_of_peers,
+        "zeta1": zeta1,
+        "zeta2": zeta2,
+        "tmean": tmean,
+        "mining_time": mining_time,
+        "max_iterations": max_iterations,
+        "adversary1_id": adversary1_id,
+        "adversary2_id": adversary2_id,
+        "blks_in_chain_adversary1": blks_in_chain_adversary1,
+        "blks_in_chain_adversary2": blks_in_chain_adversary2,
+        "tot_blks_adversary1": tot_blks_adversary1,
+        "tot_blks_adversary2": tot_blks_adversary2,
+        "tot_blks_in_chain": tot_blks_in_chain,
+        "tot_mined_blks": tot_mined_blks,
+        "mpu_adversary1": blks_in_chain_adversary1/tot_blks_adversary1 if tot_blks_adversary1 != 0 else 0,
+        "mpu_adversary2": blks_in_chain_adversary2/tot_blks_adversary2 if tot_blks_adversary2 != 0 else 0,
+        "mpu_overall": tot_blks_in_chain/tot_mined_blks if tot_mined_blks != 0 else 0,
+        "fraction_adversary1": blks_in_chain_adversary1/tot_blks_in_chain if tot_blks_in_chain != 0 else 0,
+        "fraction_adversary2": blks_in_chain_adversary2/tot_blks_in_chain if tot_blks_in_chain != 0 else 0,
+        "common_prefix_depth": N.common_prefix().depth,
+        "payload_kbits_sent": payload_kbits_sent,
+        "inv_kbits_sent": inv_kbits_sent,
+        "simulated_time": current_time,
+    }
+    if not write_output:
+        return metrics
         
     # store the output in the output folder
 
-    with open(f"output_{no_of_peers}_{zeta1}_{zeta2}_{tmean}_{mining_time}_{max_iterations}/Analysis.txt", 'w') as f:
+    with open(f"{output_directory()}/Analysis.txt", 'w') as f:
         f.write(f"No of peers: {no_of_peers}\nHashing_power_of_adversary1: {zeta1}\nHashing_power_of_adversary2: {zeta2}\nTmean: {tmean}\nMax_iterations: {max_iterations}\nMining_time: {mining_time}\n")
-        tot_blks_in_chain = N.peers[0].BlockChain.max_depth
         f.write(f"Adversary1 id: "+str(adversary1_id)+"\n")
         f.write(f"Adversary2 id: "+str(adversary2_id)+"\n")
         f.write(f"Adversary1 blocks in chain: "+str(blks_in_chain_adversary1)+"\n")
         f.write(f"Total blocks mined by Adversary1: "+str(tot_blks_adversary1)+"\n")
         f.write(f"Adversary2 blocks in chain: "+str(blks_in_chain_adversary2)+"\n")
         f.write(f"Total blocks mined by Adversary2: "+str(tot_blks_adversary2)+"\n")
+        f.write(f"Common prefix depth: {metrics['common_prefix_depth']}\n")
+        f.write(f"Relay protocol: {relay_protocol}\n")
+        f.write(f"Compact blocks: {compact_blocks}\n")
+        f.write(f"Payload kilobits sent: {payload_kbits_sent}\n")
+        f.write(f"Inventory kilobits sent: {inv_kbits_sent}\n")
         if tot_blks_adversary1 != 0:
             print("MPU node adv1: ",blks_in_chain_adversary1/tot_blks_adversary1)
             f.write(f"MPU node adv1: " + str(blks_in_chain_adversary1/tot_blks_adversary1) + "\n")
@@ -739,23 +2321,8 @@ def analysis():
 
     f.close()       
 
-    for i in range(no_of_peers):
-
-        # create the blockchain image
-        nodes = {}
-        for block in N.peers[i].BlockChain.seen_blocks:
-            color = 'black'
-            if block.creator_id == adversary1_id:
-                color = 'red'
-            if block.creator_id == adversary2_id:
-                color = 'blue'
-            if block.block_id == N.peers[i].BlockChain.longest_chain_id:
-                color = 'green'
-            nodes[block.block_id] = Node(f"Block ID: {block.block_id}\nMiner ID: {block.creator_id}\nTime: {block.time}\n Depth: {block.depth}, No of trans: {len(block.transactions_list)}\n", color=color)
-        for block in N.peers[i].BlockChain.seen_blocks:
-            if block.parent is not None:
-                nodes[block.block_id].parent = nodes[block.parent.block_id]
-        DotExporter(nodes[N.peers[i].BlockChain.root.block_id], nodeattrfunc=lambda node: f'color="{node.color}"').to_picture(f"output_{no_of_peers}_{zeta1}_{zeta2}_{tmean}_{mining_time}_{max_iterations}/Peer_{i}_BlockChain_Image.png")
+    if render_trees:
+        render_blockchains()
 
     # create the peer network graph
     Peer_Network_Graph = nx.Graph()
@@ -766,84 +2333,394 @@ def analysis():
             Peer_Network_Graph.add_edge(peer.id, neighbour_id)
     plt.figure(figsize=(20,20))
     nx.draw(Peer_Network_Graph, with_labels = True, node_size=500, font_size=12)
-    plt.savefig(f"output_{no_of_peers}_{zeta1}_{zeta2}_{tmean}_{mining_time}_{max_iterations}/Peer_Network.png")
+    plt.savefig(f"{output_directory()}/Peer_Network.png")
+    plt.close()
+    return metrics
 
 
 ############################################################################################################
-
-no_of_peers = int(input("Enter the number of peers: "))
-zeta1 = int(input("Enter the percentage hashing power of selfish miner1: "))
-zeta2 = int(input("Enter the percentage hashing power of selfish miner2: "))
-tmean = float(input("Enter the mean time between transactions(in milliseconds): "))/1000
-mining_time = float(input("Enter the mean time between the blocks(in milliseconds): "))/1000
-max_iterations = 2000000 # maximum number of iterations
-events = Events()
-
-# create the network and initialize the blockchain
-N = Network(no_of_peers,zeta1,zeta2,tmean)
-N.create_adjacency_list()
-N.generate_initial_block()
-N.generate_intitial_transaction()
-
-# store the output in the output folder
-# clear the output folder if it already exists
-if not os.path.exists(f"output_{no_of_peers}_{zeta1}_{zeta2}_{tmean}_{mining_time}_{max_iterations}"):
-    os.makedirs(f"output_{no_of_peers}_{zeta1}_{zeta2}_{tmean}_{mining_time}_{max_iterations}")
-else:
-    for the_file in os.listdir(f"output_{no_of_peers}_{zeta1}_{zeta2}_{tmean}_{mining_time}_{max_iterations}"):
-        file_path = os.path.join(f"output_{no_of_peers}_{zeta1}_{zeta2}_{tmean}_{mining_time}_{max_iterations}", the_file)
-        try:
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
-        except Exception as e:
-            print(e)
-
-# run the simulation
-for _ in tqdm(range(max_iterations)):
-    event = events.get_event()
-    if event == None:
-        break # break if there are no more events
-    else:
-        # process the event and update the current time
-        current_time = event.scheduled_time
-        if event.type == CREATE_TXN:
+# Simulation
+
+# names of the module globals that hold the state of a simulation
+SIMULATION_STATE = [
+    "no_of_peers","zeta1","zeta2","tmean","mining_time","max_iterations","events","N","current_time",
+    "transaction_id","block_id","adversary1_id","adversary2_id",
+    "blks_in_chain_adversary1","blks_in_chain_adversary2","tot_blks_adversary1","tot_blks_adversary2",
+    "tot_blks_in_chain","tot_mined_blks","payload_kbits_sent","inv_kbits_sent",
+    "genesis_balances","validation_cache","trace","rng","profiler",
+]
+
+# names of the module parameters that are saved in checkpoints and copied into the processes of a parallel simulation
+SIMULATION_SETTINGS = [
+    "max_no_of_transactions","size_of_transaction","inv_message_size","short_id_size","mining_fee","initial_balance",
+    "balance_checkpoint_interval","relay_mode","relay_protocol","compact_blocks","scheduler","max_mempool_size",
+    "max_seen_transactions","queing_delay_constant","fast_link_speed","slow_link_speed","id_stride","topology_builder","latency_model","random_streams","finality_depth",
+]
+
+def process_event(event,draining=False):
+    """
+    Function to process an event
+    While draining, only the events that move transactions and blocks through the network are processed
+    """
+    if event.type == CREATE_TXN:
+        if not draining:
             N.peers[event.sender_id].create_Transaction(event.item,event.scheduled_time)
-        elif event.type == FORWARD_TXN:
-            N.peers[event.sender_id].forward_transaction(event.item,event.reciever_id,event.scheduled_time)
-        elif event.type == RECIEVE_TXN:
-            N.peers[event.reciever_id].recieve_transaction(event.item,event.sender_id,event.scheduled_time)
-        elif event.type == CREATE_BLOCK:
+    elif event.type == FORWARD_TXN:
+        N.peers[event.sender_id].forward_transaction(event.item,event.reciever_id,event.scheduled_time)
+    elif event.type == RECIEVE_TXN:
+        N.peers[event.reciever_id].recieve_transaction(event.item,event.sender_id,event.scheduled_time)
+    elif event.type == CREATE_BLOCK:
+        if not draining:
             N.peers[event.sender_id].create_block(event.scheduled_time)
-        elif event.type == FORWARD_BLOCK:
-            N.peers[event.sender_id].forward_block(event.item,event.scheduled_time,event.reciever_id)
-        elif event.type == RECIEVE_BLOCK:
-            N.peers[event.reciever_id].recieve_block(event.item,event.scheduled_time,event.sender_id)
-        elif event.type == SUCCESSFUL_MINING:
+    elif event.type == FORWARD_BLOCK:
+        N.peers[event.sender_id].forward_block(event.item,event.scheduled_time,event.reciever_id)
+    elif event.type == RECIEVE_BLOCK:
+        N.peers[event.reciever_id].recieve_block(event.item,event.scheduled_time,event.sender_id)
+    elif event.type == SUCCESSFUL_MINING:
+        if not draining:
             N.peers[event.sender_id].successful_block(event.scheduled_time,event.item,event.misc)
+    elif event.type == FANOUT_TXN or event.type == FANOUT_BLOCK:
+        N.peers[event.sender_id].fan_out(event)
+    elif event.type == RECIEVE_INV:
+        N.peers[event.reciever_id].recieve_inv(event.item,event.sender_id,event.scheduled_time,event.misc)
+    elif event.type == RECIEVE_GETDATA:
+        N.peers[event.reciever_id].recieve_getdata(event.item,event.sender_id,event.scheduled_time,event.misc)
+    elif event.type == RECIEVE_CMPCT_BLOCK:
+        N.peers[event.reciever_id].recieve_compact_block(event.item,event.sender_id,event.scheduled_time)
+    elif event.type == RECIEVE_GETBLOCKTXN:
+        N.peers[event.reciever_id].recieve_getblocktxn(event.item,event.sender_id,event.scheduled_time,event.misc)
 
 
-# release all the selfish blocks at the end of the simulation
-if len(N.peers[adversary1_id].selfish_blocks) != 0:
-    N.peers[adversary1_id].release_all_selfish_blks(current_time)
-if len(N.peers[adversary2_id].selfish_blocks) != 0:
-    N.peers[adversary2_id].release_all_selfish_blks(current_time)
+class Simulation:
 
-# only process the forward block and recieve block events at the end of the simulation
-# to make sure that all the blocks are added to the blockchain and all peers have the same blockchain
-while events.event_list:
-    event = events.get_event()
-    current_time = event.scheduled_time
-    if event.type == RECIEVE_TXN:
-            N.peers[event.reciever_id].recieve_transaction(event.item,event.sender_id,event.scheduled_time)
-    elif event.type == RECIEVE_BLOCK:
-            N.peers[event.reciever_id].recieve_block(event.item,event.scheduled_time,event.sender_id)
-    elif event.type == FORWARD_TXN:
-            N.peers[event.sender_id].forward_transaction(event.item,event.reciever_id,event.scheduled_time)
-    elif event.type == FORWARD_BLOCK:
-            N.peers[event.sender_id].forward_block(event.item,event.scheduled_time,event.reciever_id)
-    
+    """
+    Simulation class to represent one run of the simulator
+    The peers and the event handlers read the state of the running simulation from the module globals,
+    so a simulation installs its state (listed in SIMULATION_STATE, plus the state of the random module)
+    while one of its methods runs and saves it back afterwards. Several simulations can live in one process
+    and be run one after the other or alternately, but not from several threads at the same time
+    """
+
+    def __init__(self,no_of_peers,zeta1,zeta2,tmean,mining_time,max_iterations=2000000,seed=None,topology=None):
+        """
+        Constructor to initialize the simulation
+        Args:
+        no_of_peers: number of peers in the network
+        zeta1: percentage hashing power of selfish miner1
+        zeta2: percentage hashing power of selfish miner2
+        tmean: mean time between transactions (in seconds)
+        mining_time: mean time between the blocks (in seconds)
+        max_iterations: maximum number of iterations of the main loop
+        seed: seed of the random number generator, None for a random seed
+        topology: topology snapshot to reuse instead of generating a new network
+        """
+        if zeta1 < 0 or zeta2 < 0 or zeta1 + zeta2 > 100:
+            raise ValueError("The hashing powers of the selfish miners must be non-negative and add up to at most 100 percent")
+        self.seed = seed
+        self.topology = topology
+        self.state = dict.fromkeys(SIMULATION_STATE)
+        self.state.update(
+            no_of_peers=no_of_peers,zeta1=zeta1,zeta2=zeta2,tmean=tmean,mining_time=mining_time,
+            max_iterations=max_iterations,events=create_event_queue(),current_time=0,transaction_id=0,block_id=0,
+            blks_in_chain_adversary1=0,blks_in_chain_adversary2=0,tot_blks_adversary1=0,tot_blks_adversary2=0,
+            tot_blks_in_chain=0,tot_mined_blks=0,payload_kbits_sent=0,inv_kbits_sent=0,validation_cache={},
+        )
+        self.random_state = random.Random(seed).getstate()
+        self.iterations = 0 # number of iterations of the main loop run so far
+        self.is_setup = False
+        self.is_finished = False
+
+    def activate(self):
+        """
+        Function to install the state of the simulation in the module
+        """
+        module = globals()
+        for name,value in self.state.items():
+            module[name] = value
+        random.setstate(self.random_state)
+
+    def deactivate(self):
+        """
+        Function to save the state of the simulation from the module
+        """
+        module = globals()
+        for name in SIMULATION_STATE:
+            self.state[name] = module[name]
+        self.random_state = random.getstate()
+
+    def setup(self):
+        """
+        Function to create the network and schedule the first transactions and blocks
+        """
+        self.activate()
+        try:
+            global N,rng
+            N = Network(no_of_peers,zeta1,zeta2,tmean,self.topology)
+            if random_streams:
+                # the seed of the streams is drawn from the seeded random module, so it follows the seed of the simulation
+                rng = RandomStreams(random.getrandbits(128))
+                for peer in N.peers:
+                    peer.use_streams(rng)
+            if trace is not None:
+                trace.set_network(no_of_peers,adversary1_id,adversary2_id)
+            if self.topology is None:
+                N.create_adjacency_list()
+            N.generate_initial_block()
+            N.generate_intitial_transaction()
+            self.is_setup = True
+        finally:
+            self.deactivate()
+
+    def step(self,iterations,show_progress=False):
+        """
+        Function to run at most iterations iterations of the main loop
+        Returns the number of iterations run, which is smaller if there are no more events or max_iterations is reached
+        """
+        global current_time
+        if not self.is_setup:
+            self.setup()
+        iterations = min(iterations,self.state["max_iterations"] - self.iterations)
+        self.activate()
+        done = 0
+        if profiler is not None:
+            profiler.begin()
+        try:
+            for _ in (tqdm(range(iterations)) if show_progress else range(iterations)):
+                event = events.get_event()
+                if event == None:
+                    break # break if there are no more events
+                # process the event and update the current time
+                current_time = event.scheduled_time
+                if profiler is not None:
+                    profiler.process(event)
+                else:
+                    process_event(event)
+                done += 1
+        finally:
+            if profiler is not None:
+                profiler.end()
+            self.iterations += done
+            self.deactivate()
+        return done
+
+    def drain(self):
+        """
+        Function to release the selfish blocks and process the remaining network events,
+        so that all the blocks are added to the blockchain and all peers have the same blockchain
+        The simulated time stays at the end of the main loop, the drain only completes the deliveries in flight
+        """
+        self.activate()
+        try:
+            # release all the selfish blocks at the end of the simulation
+            if len(N.peers[adversary1_id].selfish_blocks) != 0:
+                N.peers[adversary1_id].release_all_selfish_blks(current_time)
+            if len(N.peers[adversary2_id].selfish_blocks) != 0:
+                N.peers[adversary2_id].release_all_selfish_blks(current_time)
+
+            # only process the forward block and recieve block events at the end of the simulation
+            if profiler is not None:
+                profiler.begin()
+            while len(events):
+                event = events.get_event()
+                if profiler is not None:
+                    profiler.process(event,draining=True)
+                else:
+                    process_event(event,draining=True)
+            if profiler is not None:
+                profiler.end()
+            if trace is not None:
+                trace.close()
+            self.is_finished = True
+        finally:
+            self.deactivate()
+
+    def analyse(self,write_output=True):
+        """
+        Function to analyse the simulation, see analysis()
+        """
+        self.activate()
+        try:
+            if write_output:
+                # store the output in the output folder
+                # clear the output folder if it already exists
+                if not os.path.exists(output_directory()):
+                    os.makedirs(output_directory())
+                else:
+                    for the_file in os.listdir(output_directory()):
+                        file_path = os.path.join(output_directory(), the_file)
+                        try:
+                            if os.path.isfile(file_path):
+                                os.unlink(file_path)
+                        except Exception as e:
+                            print(e)
+                print("Analysis of the output...")
+                print("adversary1_id: ",adversary1_id)
+                print("adversary2_id: ",adversary2_id)
+            metrics = analysis(write_output) # analysis of the output
+        finally:
+            self.deactivate()
+        metrics["seed"] = self.seed
+        return metrics
+
+    def run(self,write_output=True,show_progress=True,checkpoint_path=None,checkpoint_interval=100000):
+        """
+        Function to run the simulation to the end and analyse it
+        A simulation loaded from a checkpoint continues from where the checkpoint was saved
+        Args:
+        write_output: whether to write the output folder
+        show_progress: whether to show a progress bar
+        checkpoint_path: file to save a checkpoint to every checkpoint_interval iterations, None for no checkpoints
+        checkpoint_interval: number of iterations between two checkpoints
+        Returns the metrics of the simulation computed by analysis()
+        """
+        if checkpoint_path is None:
+            self.step(self.state["max_iterations"] - self.iterations,show_progress)
+        else:
+            while self.iterations < self.state["max_iterations"]:
+                if show_progress:
+                    print(f"Iterations {self.iterations}/{self.state['max_iterations']}")
+                done = self.step(checkpoint_interval,show_progress)
+                self.save(checkpoint_path)
+                if done < checkpoint_interval:
+                    break # break if there are no more events
+        if not self.is_finished:
+            self.drain()
+        return self.analyse(write_output)
+
+    def trace_to(self,path,transactions=True):
+        """
+        Function to stream a trace of the simulation to a file, see TraceWriter
+        Args:
+        path: file of the trace
+        transactions: whether to trace the transactions, which are most of the records
+        """
+        if self.state["trace"] is not None:
+            self.state["trace"].close()
+        self.state["trace"] = TraceWriter(path,transactions)
+        if self.is_setup:
+            self.state["trace"].set_network(self.state["no_of_peers"],self.state["adversary1_id"],self.state["adversary2_id"])
+
+    def profile(self,report_interval=None,sample_interval=1.0):
+        """
+        Function to measure the events processed from now on, see EventProfiler
+        Args:
+        report_interval: number of events between two report lines, None for no reports
+        sample_interval: simulated seconds between two samples of the queue, blockchain and mempool sizes
+        Returns the EventProfiler, whose summary() has the measurements
+        """
+        self.state["profiler"] = EventProfiler(report_interval,sample_interval)
+        return self.state["profiler"]
+
+    def save(self,path):
+        """
+        Function to save a checkpoint of the simulation to a file, compressed if the path ends with .gz
+        The checkpoint has the network, the pending events, the counters, the state of the random number
+        generator and the module parameters, so loading it continues the run exactly
+        """
+        checkpoint = {"settings": {name: globals()[name] for name in SIMULATION_SETTINGS},"simulation": self}
+        open_file = gzip.open if path.endswith(".gz") else open
+        # write a temporary file first, so a crash while saving keeps the previous checkpoint
+        with open_file(path + ".tmp","wb") as f:
+            pickle.dump(checkpoint,f,pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp",path)
+
+    def fork(self,seed=None):
+        """
+        Function to copy the simulation, to continue a run in several variants
+        The copy is not traced or profiled, use trace_to to trace it to its own file
+        Args:
+        seed: seed for the random number generator of the copy, None to keep the same random numbers
+        """
+        copy = pickle.loads(pickle.dumps(self,pickle.HIGHEST_PROTOCOL))
+        copy.state["trace"] = None
+        copy.state["profiler"] = None
+        if seed is not None:
+            copy.random_state = random.Random(seed).getstate()
+            if copy.state["rng"] is not None:
+                copy.state["rng"] = RandomStreams(random.Random(f"{seed}:streams").getrandbits(128))
+                for peer in copy.state["N"].peers:
+                    peer.use_streams(copy.state["rng"])
+        return copy
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        if self.state["N"] is not None:
+            self.state["N"].relink_blocks()
+
+    def network_topology(self):
+        """
+        Function to take a snapshot of the topology of the network, to be reused by other simulations
+        """
+        if not self.is_setup:
+            self.setup()
+        return self.state["N"].topology()
+
+
+def load_simulation(path,resume_trace=False):
+    """
+    Function to load a simulation from a checkpoint saved by Simulation.save()
+    The module parameters saved in the checkpoint replace the current ones
+    A checkpoint can be loaded several times to continue it in several variants
+    Args:
+    path: file of the checkpoint
+    resume_trace: whether to continue the trace of the simulation in its file, otherwise the loaded simulation is not traced
+    """
+    open_file = gzip.open if path.endswith(".gz") else open
+    with open_file(path,"rb") as f:
+        checkpoint = pickle.load(f)
+    globals().update(checkpoint["settings"])
+    simulation = checkpoint["simulation"]
+    if simulation.state["trace"] is not None:
+        if resume_trace:
+            simulation.state["trace"].reopen()
+        else:
+            simulation.state["trace"] = None
+    return simulation
+
+def generate_topology(no_of_peers,seed=None):
+    """
+    Function to generate a topology snapshot that can be shared by several simulations
+    """
+    return Simulation(no_of_peers,0,0,1,1,0,seed).network_topology()
+
+def run_simulation(peers,hashing_power1,hashing_power2,txn_mean_time,block_mean_time,iterations=2000000,seed=None,write_output=True,show_progress=True,topology=None,checkpoint_path=None,checkpoint_interval=100000,trace_path=None,profile_path=None):
+    """
+    Function to run a simulation
+    Args:
+    peers: number of peers in the network
+    hashing_power1: percentage hashing power of selfish miner1
+    hashing_power2: percentage hashing power of selfish miner2
+    txn_mean_time: mean time between transactions (in seconds)
+    block_mean_time: mean time between the blocks (in seconds)
+    iterations: maximum number of iterations of the main loop
+    seed: seed of the random number generator, None for a random seed
+    write_output: whether to write the output folder
+    show_progress: whether to show a progress bar
+    topology: topology snapshot to reuse instead of generating a new network
+    checkpoint_path: file to save a checkpoint to every checkpoint_interval iterations, None for no checkpoints
+    checkpoint_interval: number of iterations between two checkpoints
+    trace_path: file to stream a trace of the simulation to, None for no trace
+    profile_path: JSON file to write the measurements of the events to (see EventProfiler), None for no profiling
+    Returns the metrics of the simulation computed by analysis()
+    """
+    simulation = Simulation(peers,hashing_power1,hashing_power2,txn_mean_time,block_mean_time,iterations,seed,topology)
+    if trace_path is not None:
+        simulation.trace_to(trace_path)
+    if profile_path is not None:
+        profiler = simulation.profile(report_interval=100000 if show_progress else None)
+    metrics = simulation.run(write_output,show_progress,checkpoint_path,checkpoint_interval)
+    if profile_path is not None:
+        profiler.write(profile_path)
+    return metrics
+
+
+############################################################################################################
 
-print("Analysis of the output...")
-print("adversary1_id: ",adversary1_id)
-print("adversary2_id: ",adversary2_id)
-analysis() # analysis of the output
+if __name__ == "__main__":
+    run_simulation(
+        int(input("Enter the number of peers: ")),
+        int(input("Enter the percentage hashing power of selfish miner1: ")),
+        int(input("Enter the percentage hashing power of selfish miner2: ")),
+        float(input("Enter the mean time between transactions(in milliseconds): "))/1000,
+        float(input("Enter the mean time between the blocks(in milliseconds): "))/1000,
+    )
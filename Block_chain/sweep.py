@@ -0,0 +1,128 @@
+import argparse
+import csv
+import itertools
+import os
+import statistics
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import simulator
+
+
+# Parameters of a sweep point and the metrics of a run that are aggregated over the replicates
+PARAMETERS = ["no_of_peers","zeta1","zeta2","tmean","mining_time"]
+AGGREGATED_METRICS = ["mpu_adversary1","mpu_adversary2","mpu_overall","fraction_adversary1","fraction_adversary2","tot_blks_in_chain","tot_mined_blks"]
+
+############################################################################################################
+
+def build_grid(no_of_peers,zeta1,zeta2,tmean,mining_time,replicates,base_seed):
+    """
+    Function to build the list of runs of a sweep
+    Args:
+    no_of_peers, zeta1, zeta2, tmean, mining_time: lists of values of each parameter (tmean and mining_time in seconds)
+    replicates: number of runs of each point of the grid
+    base_seed: seed of the first run, the other runs use the following seeds
+    Returns a list of dictionaries with the parameters and the seed of each run
+    """
+    runs = []
+    seed = base_seed
+    for point in itertools.product(no_of_peers,zeta1,zeta2,tmean,mining_time):
+        for replicate in range(replicates):
+            run = dict(zip(PARAMETERS,point))
+            run["replicate"] = replicate
+            run["seed"] = seed
+            runs.append(run)
+            seed += 1
+    return runs
+
+def run_point(run,max_iterations):
+    """
+    Function to run one simulation of a sweep in a worker process
+    Returns the run with its metrics, or with the error if the simulation failed
+    """
+    result = dict(run)
+    for key in AGGREGATED_METRICS:
+        result[key] = ""
+    try:
+        metrics = simulator.run_simulation(run["no_of_peers"],run["zeta1"],run["zeta2"],run["tmean"],run["mining_time"],
+                                           max_iterations,seed=run["seed"],write_output=False,show_progress=False)
+        for key in AGGREGATED_METRICS:
+            result[key] = metrics[key]
+        result["error"] = ""
+    except Exception:
+        result["error"] = traceback.format_exc().strip().splitlines()[-1]
+    return result
+
+def run_sweep(runs,max_iterations,workers=None):
+    """
+    Function to run the simulations of a sweep on a pool of worker processes
+    Returns the results of the runs in the order of runs
+    """
+    results = [None]*len(runs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_point,run,max_iterations): i for i,run in enumerate(runs)}
+        for done,future in enumerate(as_completed(futures),1):
+            i = futures[future]
+            results[i] = future.result()
+            status = "failed: " + results[i]["error"] if results[i]["error"] else "done"
+            print(f"[{done}/{len(runs)}] {', '.join(f'{key}={runs[i][key]}' for key in PARAMETERS)} seed={runs[i]['seed']} {status}")
+    return results
+
+def aggregate(results):
+    """
+    Function to aggregate the results of the replicates of every point of the grid
+    Returns a list of dictionaries with the mean and standard deviation of every metric,
+    the number of successful runs and the number of failed runs of each point
+    """
+    points = {}
+    for result in results:
+        points.setdefault(tuple(result[key] for key in PARAMETERS),[]).append(result)
+    table = []
+    for point,point_results in points.items():
+        row = dict(zip(PARAMETERS,point))
+        succeeded = [result for result in point_results if not result["error"]]
+        row["runs"] = len(succeeded)
+        row["failed_runs"] = len(point_results) - len(succeeded)
+        for key in AGGREGATED_METRICS:
+            values = [result[key] for result in succeeded]
+            row[key + "_mean"] = statistics.mean(values) if values else ""
+            row[key + "_std"] = statistics.stdev(values) if len(values) > 1 else 0 if values else ""
+        table.append(row)
+    return table
+
+def write_csv(path,rows):
+    """
+    Function to write a list of dictionaries to a csv file
+    """
+    with open(path,'w',newline='') as f:
+        writer = csv.DictWriter(f,fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+############################################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a grid of blockchain simulations in parallel")
+    parser.add_argument("--peers",type=int,nargs="+",default=[20],help="numbers of peers")
+    parser.add_argument("--zeta1",type=int,nargs="+",default=[20],help="percentage hashing powers of selfish miner1")
+    parser.add_argument("--zeta2",type=int,nargs="+",default=[20],help="percentage hashing powers of selfish miner2")
+    parser.add_argument("--tmean",type=float,nargs="+",default=[10],help="mean times between transactions (in milliseconds)")
+    parser.add_argument("--mining-time",type=float,nargs="+",default=[100],help="mean times between the blocks (in milliseconds)")
+    parser.add_argument("--replicates",type=int,default=1,help="number of runs of each point of the grid")
+    parser.add_argument("--seed",type=int,default=0,help="seed of the first run")
+    parser.add_argument("--max-iterations",type=int,default=2000000,help="maximum number of iterations of each run")
+    parser.add_argument("--workers",type=int,default=os.cpu_count(),help="number of worker processes")
+    parser.add_argument("--output",default="sweep",help="prefix of the output csv files")
+    args = parser.parse_args()
+
+    runs = build_grid(args.peers,args.zeta1,args.zeta2,[i/1000 for i in args.tmean],[i/1000 for i in args.mining_time],args.replicates,args.seed)
+    results = run_sweep(runs,args.max_iterations,args.workers)
+    table = aggregate(results)
+    write_csv(f"{args.output}_runs.csv",results)
+    write_csv(f"{args.output}_summary.csv",table)
+
+    failed = [result for result in results if result["error"]]
+    print(f"{len(results) - len(failed)} runs succeeded, {len(failed)} runs failed")
+    for result in failed:
+        print(f"failed: {', '.join(f'{key}={result[key]}' for key in PARAMETERS)} seed={result['seed']}: {result['error']}")
+    print(f"Results written to {args.output}_runs.csv and {args.output}_summary.csv")
@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+import simulator
+
+
+def build_tree(seed,no_of_blocks):
+    """
+    Function to build a random block tree with long chains and many short forks
+    Returns the list of blocks, the genesis block first
+    """
+    generator = random.Random(seed)
+    genesis = simulator.Block([],-1,-1,0,None)
+    blocks = [genesis]
+    for _ in range(no_of_blocks):
+        # mostly extend one of the newest blocks, sometimes fork from anywhere in the tree
+        parent = generator.choice(blocks[-20:]) if generator.random() < 0.9 else generator.choice(blocks)
+        blocks.append(parent.add_child(simulator.Block([],parent.block_id,1,0,None)))
+    return blocks
+
+def naive_ancestor(block,depth,blocks_by_id):
+    """
+    Function to get the ancestor of a block at a depth by following the previous block ids one by one
+    """
+    if depth < 0 or depth > block.depth:
+        return None
+    while block.depth > depth:
+        block = blocks_by_id[block.prev_block_id]
+    return block
+
+def naive_common_ancestor(block1,block2):
+    """
+    Function to get the last common ancestor of two blocks by walking the parents
+    """
+    ancestors = set()
+    while block1 is not None:
+        ancestors.add(block1.block_id)
+        block1 = block1.parent
+    while block2.block_id not in ancestors:
+        block2 = block2.parent
+    return block2
+
+
+@pytest.mark.parametrize("seed",range(3))
+def test_ancestor_matches_naive_walk(seed):
+    blocks = build_tree(seed,2000)
+    blocks_by_id = {block.block_id: block for block in blocks}
+    generator = random.Random(seed)
+    for _ in range(2000):
+        block = generator.choice(blocks)
+        depth = generator.randint(-1,block.depth + 1)
+        assert block.ancestor(depth) is naive_ancestor(block,depth,blocks_by_id)
+        k = generator.randint(0,block.depth)
+        assert block.kth_ancestor(k) is naive_ancestor(block,block.depth - k,blocks_by_id)
+
+
+@pytest.mark.parametrize("seed",range(3))
+def test_common_ancestor_and_reorg_depth_match_naive_walk(seed):
+    blocks = build_tree(seed,2000)
+    generator = random.Random(seed)
+    for _ in range(2000):
+        old_tip,new_tip = generator.sample(blocks,2)
+        expected = naive_common_ancestor(old_tip,new_tip)
+        assert simulator.common_ancestor(old_tip,new_tip) is expected
+        assert simulator.reorg_depth(old_tip,new_tip) == old_tip.depth - expected.depth
+        assert simulator.reorg_depth(old_tip,old_tip) == 0
+
+
+def test_common_ancestor_compares_genesis_by_id():
+    blocks = build_tree(0,200)
+    other_genesis = simulator.Block([],-1,-1,0,None) # every peer has its own genesis block
+    fork = other_genesis.add_child(simulator.Block([],0,2,0,None))
+    assert simulator.common_ancestor(blocks[-1],fork).block_id == 0
+    assert simulator.reorg_depth(blocks[-1],fork) == blocks[-1].depth
@@ -0,0 +1,66 @@
+import heapq
+import random
+
+import pytest
+
+import simulator
+
+
+def run_against_heap(queue,seed,operations):
+    """
+    Function to push and pop random events on queue and on a heap of (scheduled time, sequence number, event)
+    Events are scheduled no earlier than the last event popped, like in the simulation, and the times are rounded
+    to a few milliseconds so many events share their scheduled time
+    Returns the events popped from queue and from the heap
+    """
+    generator = random.Random(seed)
+    heap = []
+    sequence = 0
+    now = 0
+    popped_queue = []
+    popped_heap = []
+    for i in range(operations):
+        if heap and generator.random() < 0.45:
+            event = queue.get_event()
+            popped_queue.append(event)
+            popped_heap.append(heapq.heappop(heap)[2])
+            now = event.scheduled_time
+        else:
+            scheduled_time = now + round(generator.expovariate(1 / 0.05),3)
+            event = simulator.Event(scheduled_time,0,0,i,simulator.CREATE_TXN)
+            queue.add_event(event)
+            heapq.heappush(heap,(scheduled_time,sequence,event))
+            sequence += 1
+        if i == operations // 2:
+            queue.rebuild(queue.no_of_buckets) # resize in the middle of the run with a new bucket width
+    while heap:
+        popped_queue.append(queue.get_event())
+        popped_heap.append(heapq.heappop(heap)[2])
+    return popped_queue,popped_heap
+
+
+@pytest.mark.parametrize("seed",range(5))
+def test_calendar_queue_matches_heap(seed):
+    queue = simulator.CalendarQueue()
+    popped_queue,popped_heap = run_against_heap(queue,seed,5000)
+    assert [event.item for event in popped_queue] == [event.item for event in popped_heap]
+    assert len(queue) == 0 and queue.get_event() is None
+
+
+def test_calendar_queue_grows_and_shrinks():
+    queue = simulator.CalendarQueue(bucket_width=1)
+    heap = []
+    for i in range(1000):
+        scheduled_time = round(random.Random(i).random(),2) # many equal times
+        queue.add_event(simulator.Event(scheduled_time,0,0,i,simulator.CREATE_TXN))
+        heapq.heappush(heap,(scheduled_time,i))
+    assert queue.no_of_buckets > simulator.CalendarQueue.min_no_of_buckets
+    assert [queue.get_event().item for _ in range(1000)] == [heapq.heappop(heap)[1] for _ in range(1000)]
+    assert queue.no_of_buckets == simulator.CalendarQueue.min_no_of_buckets
+
+
+def test_heap_events_keep_insertion_order_for_equal_times():
+    queue = simulator.Events()
+    for i in range(100):
+        queue.add_event(simulator.Event(1.0,0,0,i,simulator.CREATE_TXN))
+    assert [queue.get_event().item for _ in range(100)] == list(range(100))
@@ -0,0 +1,57 @@
+import pytest
+
+import parallel
+import simulator
+
+
+def run(seed,finality_depth,monkeypatch,checkpoint_path=None):
+    """
+    Function to run an honest-only simulation with a finality depth, through a checkpoint if checkpoint_path is given
+    Returns the metrics and the network of the simulation
+    """
+    monkeypatch.setattr(simulator,"render_trees",False)
+    monkeypatch.setattr(simulator,"finality_depth",finality_depth)
+    simulation = simulator.Simulation(10,0,0,0.05,0.05,60000,seed)
+    if checkpoint_path is not None:
+        simulation.step(30000)
+        simulation.save(checkpoint_path)
+        simulation = simulator.load_simulation(checkpoint_path)
+    metrics = simulation.run(write_output=False,show_progress=False)
+    return metrics,simulation.state["N"]
+
+
+@pytest.mark.parametrize("seed",[1,2,3])
+def test_pruning_does_not_change_honest_runs(seed,monkeypatch,capsys):
+    unpruned,_ = run(seed,None,monkeypatch)
+    pruned,network = run(seed,6,monkeypatch)
+    assert network.final_depth > 0 and unpruned["tot_mined_blks"] > unpruned["tot_blks_in_chain"] # the run pruned stale branches
+    assert pruned == unpruned
+
+
+def test_pruning_survives_a_checkpoint(monkeypatch,tmp_path):
+    unpruned,_ = run(1,None,monkeypatch)
+    pruned,network = run(1,6,monkeypatch,str(tmp_path / "checkpoint.pkl"))
+    assert pruned == unpruned
+    assert network.final_chain[0].depth == 1 and network.final_chain[-1].depth == network.final_depth - 1
+
+
+def test_pruning_bounds_the_blocks_kept_by_the_peers(monkeypatch):
+    monkeypatch.setattr(simulator,"render_trees",False)
+    monkeypatch.setattr(simulator,"finality_depth",6)
+    simulation = simulator.Simulation(20,0,0,0.05,0.05,600000,1)
+    sizes = []
+    for _ in range(4):
+        simulation.step(150000)
+        peers = simulation.state["N"].peers
+        sizes.append((max(len(peer.BlockChain.block_index) for peer in peers),max(len(peer.pruned_blocks) for peer in peers)))
+    assert simulation.state["N"].final_depth > 40
+    # the blockchains only keep the blocks of the last few finality windows, however long the run
+    assert all(blocks <= 100 and pruned <= 100 for blocks,pruned in sizes)
+    assert sizes[-1][0] <= max(blocks for blocks,_ in sizes[:-1]) # they do not grow with the run
+    assert sizes[-1][1] <= max(pruned for _,pruned in sizes[:-1])
+
+
+def test_parallel_simulation_rejects_finality_depth(monkeypatch):
+    monkeypatch.setattr(simulator,"finality_depth",2)
+    with pytest.raises(ValueError):
+        parallel.run_parallel_simulation(10,0,0,0.05,0.05,seed=1,partitions=2)
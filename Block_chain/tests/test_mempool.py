@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+import simulator
+
+
+def build_fork(generator,transactions):
+    """
+    Function to build a block tree with two long branches and short forks, whose blocks take a coinbase transaction
+    and random transactions not yet in their chain (a transaction can be in several branches)
+    Returns the list of blocks, the genesis block first
+    """
+    genesis = simulator.Block([],-1,-1,0,None)
+    blocks = [genesis]
+    for i in range(60):
+        parent = blocks[-2] if i % 2 else blocks[-1] if i < 4 else generator.choice(blocks)
+        coinbase = simulator.Transaction(simulator.coinbase_id,1,simulator.mining_fee,0)
+        in_chain = chain_transactions(parent)
+        unconfirmed = [txn for txn in transactions if txn.transaction_id not in in_chain]
+        block = simulator.Block([coinbase] + generator.sample(unconfirmed,5),parent.block_id,1,0,None)
+        blocks.append(parent.add_child(block))
+    return blocks
+
+def chain_transactions(tip):
+    """
+    Function to get the ids of the transactions (without the coinbases) in the chain ending at tip
+    """
+    ids = set()
+    while tip is not None:
+        ids.update(txn.transaction_id for txn in tip.transactions_list if txn.sender != simulator.coinbase_id)
+        tip = tip.parent
+    return ids
+
+
+@pytest.mark.parametrize("seed",range(5))
+def test_update_tip_matches_recomputation(seed):
+    generator = random.Random(seed)
+    transactions = [simulator.Transaction(i % 5,(i + 1) % 5,1,0) for i in range(200)]
+    blocks = build_fork(generator,transactions)
+    mempool = simulator.Mempool(blocks[0],max_size=10**6,max_confirmed=10**6)
+    for txn in transactions:
+        mempool.add_transaction(txn)
+    # switch between the tips of the branches both ways, to ancestors and back to the genesis block
+    tips = [block for block in blocks if not block.children]
+    for tip in [tips[0],tips[-1],tips[0]] + [generator.choice(blocks) for _ in range(200)] + [blocks[0]]:
+        mempool.update_tip(tip)
+        confirmed = chain_transactions(tip)
+        assert mempool.tip is tip
+        assert set(mempool.unconfirmed) == {txn.transaction_id for txn in transactions} - confirmed
+        assert set(mempool.confirmed) == confirmed
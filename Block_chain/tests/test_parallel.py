@@ -0,0 +1,47 @@
+import pytest
+
+import parallel
+import simulator
+
+
+def make_block(parent,creator_id):
+    """
+    Function to mine a block with no transactions on top of parent, with the balances of its creator increased
+    """
+    block = simulator.Block([],parent.block_id,creator_id,0,None)
+    changes = parent.peer_balances.begin()
+    changes[creator_id] = parent.peer_balances[creator_id] + 1
+    block.peer_balances = parent.peer_balances.apply(changes)
+    return parent.add_child(block)
+
+
+def test_registry_exports_an_orphan_before_its_parent(monkeypatch):
+    monkeypatch.setattr(simulator,"no_of_peers",4)
+    genesis = simulator.Block([],-1,-1,0,simulator.genesis_peer_balances())
+    parent = make_block(genesis,1)
+    child = make_block(parent,2)
+    sender = parallel.BlockRegistry(genesis)
+    reciever = parallel.BlockRegistry(simulator.Block([],-1,-1,0,genesis.peer_balances))
+    child_wire = sender.export_block(child)
+    orphan = reciever.import_block(child_wire)
+    assert orphan.peer_balances is None
+    assert reciever.export_block(orphan) == child_wire # an honest peer relays the orphan on
+    reciever.import_block(sender.export_block(parent))
+    assert orphan.peer_balances.to_list() == child.peer_balances.to_list()
+    assert reciever.export_block(orphan) == child_wire
+
+
+def test_next_time_sees_events_added_after_the_held_event():
+    events = parallel.PartitionEvents(simulator.Events(),[0],0,None)
+    events.add_event(simulator.Event(5.0,0,0,None,simulator.CREATE_TXN))
+    assert events.next_time() == 5.0
+    events.add_event(simulator.Event(2.0,0,0,None,simulator.CREATE_TXN)) # like the release of the selfish blocks
+    assert events.next_time() == 2.0
+    assert len(events) == 2
+
+
+@pytest.mark.parametrize("seed",[1,2])
+def test_parallel_simulation_with_many_forks(seed):
+    # short mining times make many forks, so blocks often reach a partition before their parent
+    metrics = parallel.run_parallel_simulation(30,30,25,1.0,0.01,150000,seed=seed,partitions=3,show_progress=False)
+    assert 0 < metrics["tot_blks_in_chain"] <= metrics["tot_mined_blks"]
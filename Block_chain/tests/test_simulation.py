@@ -0,0 +1,11 @@
+import simulator
+
+
+def test_simulated_time_is_the_end_of_the_main_loop(monkeypatch,capsys):
+    monkeypatch.setattr(simulator,"render_trees",False)
+    simulation = simulator.Simulation(20,20,20,0.01,0.1,100000,1)
+    simulation.step(100000)
+    end_of_main_loop = simulation.state["current_time"]
+    simulation.drain() # drops the mining and transaction events scheduled after the end of the main loop
+    metrics = simulation.analyse(write_output=False)
+    assert metrics["simulated_time"] == end_of_main_loop
@@ -0,0 +1,225 @@
+import argparse
+import math
+import os
+
+import numpy as np
+
+from simulator import TraceWriter, TRACE_HEADER_SIZE, TRACE_TXN_CREATED, TRACE_TXN_RECIEVED, TRACE_BLOCK_MINED, TRACE_BLOCK_ADDED, TRACE_TIP_CHANGED
+
+
+# Layout of a trace record, the same as TraceWriter.record
+TRACE_DTYPE = np.dtype([("time","<f8"),("item","<i8"),("parent","<i8"),("peer","<i4"),("depth","<i4"),("aux","<i4"),("kind","<i4")])
+assert TRACE_DTYPE.itemsize == TraceWriter.record.size
+
+############################################################################################################
+
+class TraceReader:
+
+    """
+    TraceReader class to analyse a trace written by simulator.TraceWriter
+    The records are memory-mapped, so only the records an analysis selects are loaded into memory
+    """
+
+    def __init__(self,path):
+        """
+        Constructor to open a trace
+        Args:
+        path: file of the trace
+        """
+        with open(path,"rb") as f:
+            magic,version,record_size,no_of_peers,adversary1_id,adversary2_id,count = TraceWriter.header.unpack_from(f.read(TRACE_HEADER_SIZE))
+        if magic != TraceWriter.magic:
+            raise ValueError(f"{path} is not a trace")
+        if version != TraceWriter.version or record_size != TRACE_DTYPE.itemsize:
+            raise ValueError(f"{path} is a trace of version {version}, this reader reads version {TraceWriter.version}")
+        # the header is written when the records are flushed, so a trace of a run that crashed can have more records
+        count = max(count,(os.path.getsize(path) - TRACE_HEADER_SIZE) // record_size)
+        self.path = path
+        self.no_of_peers = no_of_peers
+        self.adversary1_id = adversary1_id
+        self.adversary2_id = adversary2_id
+        if count:
+            self.records = np.memmap(path,dtype=TRACE_DTYPE,mode="r",offset=TRACE_HEADER_SIZE,shape=(count,))
+        else:
+            self.records = np.zeros(0,dtype=TRACE_DTYPE)
+        self.kinds = self.records["kind"]
+        self.mined = np.sort(self.of_kind(TRACE_BLOCK_MINED),order="item") # mined blocks, by block id
+        self.parents = dict(zip(self.mined["item"].tolist(),self.mined["parent"].tolist())) # block id -> parent block id
+        self.depths = dict(zip(self.mined["item"].tolist(),self.mined["depth"].tolist())) # block id -> depth
+        self.depths[0] = 0
+
+    def of_kind(self,kind):
+        """
+        Function to load the records of one kind, in the order they were written
+        """
+        return self.records[self.kinds == kind]
+
+    def final_tips(self):
+        """
+        Function to get the last block of the longest chain of every peer at the end of the trace
+        Returns a dictionary peer id -> block id
+        """
+        tips = self.of_kind(TRACE_TIP_CHANGED)
+        peers,last = np.unique(tips["peer"][::-1],return_index=True) # the last tip change of every peer
+        return dict(zip(peers.tolist(),tips["item"][::-1][last].tolist()))
+
+    def analysed_peer(self):
+        """
+        Function to get the peer used for the analyses by default: the honest peer with the longest chain
+        """
+        tips = self.final_tips()
+        honest = [peer_id for peer_id in tips if peer_id not in (self.adversary1_id,self.adversary2_id)] or list(tips)
+        return max(honest,key=lambda peer_id: (self.depths[tips[peer_id]],-peer_id))
+
+    def main_chain(self,peer_id=None):
+        """
+        Function to get the ids of the blocks of the longest chain of a peer at the end of the trace,
+        from the first block after the genesis block to the tip
+        """
+        if peer_id is None:
+            peer_id = self.analysed_peer()
+        chain = []
+        block_id = self.final_tips().get(peer_id,0)
+        while block_id != 0:
+            chain.append(block_id)
+            block_id = self.parents[block_id]
+        chain.reverse()
+        return np.array(chain,dtype=np.int64)
+
+    def mpu(self,peer_id=None):
+        """
+        Function to get the mining power utilization and the fraction of blocks of the adversaries,
+        with the same names as the metrics of simulator.analysis()
+        """
+        chain = self.main_chain(peer_id)
+        creators = self.mined["peer"]
+        in_chain = np.isin(self.mined["item"],chain)
+        tot_blks_adversary1 = int(np.count_nonzero(creators == self.adversary1_id))
+        tot_blks_adversary2 = int(np.count_nonzero(creators == self.adversary2_id))
+        blks_in_chain_adversary1 = int(np.count_nonzero(in_chain & (creators == self.adversary1_id)))
+        blks_in_chain_adversary2 = int(np.count_nonzero(in_chain & (creators == self.adversary2_id)))
+        tot_blks_in_chain = len(chain)
+        tot_mined_blks = len(self.mined)
+        return {
+            "blks_in_chain_adversary1": blks_in_chain_adversary1,
+            "blks_in_chain_adversary2": blks_in_chain_adversary2,
+            "tot_blks_adversary1": tot_blks_adversary1,
+            "tot_blks_adversary2": tot_blks_adversary2,
+            "tot_blks_in_chain": tot_blks_in_chain,
+            "tot_mined_blks": tot_mined_blks,
+            "mpu_adversary1": blks_in_chain_adversary1/tot_blks_adversary1 if tot_blks_adversary1 != 0 else 0,
+            "mpu_adversary2": blks_in_chain_adversary2/tot_blks_adversary2 if tot_blks_adversary2 != 0 else 0,
+            "mpu_overall": tot_blks_in_chain/tot_mined_blks if tot_mined_blks != 0 else 0,
+            "fraction_adversary1": blks_in_chain_adversary1/tot_blks_in_chain if tot_blks_in_chain != 0 else 0,
+            "fraction_adversary2": blks_in_chain_adversary2/tot_blks_in_chain if tot_blks_in_chain != 0 else 0,
+        }
+
+    def forks(self,peer_id=None):
+        """
+        Function to analyse the forks of the trace
+        Returns a dictionary with the number of stale blocks (mined but not in the main chain), the stale rate,
+        the number of forks (stale branches leaving the main chain) and their lengths, and the number of
+        reorganisations (a peer switching its longest chain to another branch) and their depths
+        """
+        main = set(self.main_chain(peer_id).tolist())
+        main.add(0)
+        # the root of the stale branch of every stale block, and the length of every branch
+        fork_lengths = {}
+        for block_id in self.parents:
+            if block_id in main:
+                continue
+            root = block_id
+            while self.parents[root] not in main:
+                root = self.parents[root]
+            length = self.depths[block_id] - self.depths[root] + 1
+            fork_lengths[root] = max(fork_lengths.get(root,0),length)
+
+        # a tip change that does not extend the previous tip is a reorganisation
+        reorg_depths = []
+        tips = self.of_kind(TRACE_TIP_CHANGED)
+        previous_tips = {} # peer id -> block id of the previous tip
+        for peer_id,block_id,parent_id in zip(tips["peer"].tolist(),tips["item"].tolist(),tips["parent"].tolist()):
+            previous = previous_tips.get(peer_id,0)
+            previous_tips[peer_id] = block_id
+            if parent_id == previous:
+                continue
+            # walk both tips back to their common ancestor
+            old,new = previous,parent_id
+            while old != new:
+                if self.depths[old] >= self.depths[new]:
+                    old = self.parents[old]
+                else:
+                    new = self.parents[new]
+            reorg_depths.append(self.depths[previous] - self.depths[old])
+
+        no_of_stale = len(self.parents) - (len(main) - 1)
+        return {
+            "stale_blocks": no_of_stale,
+            "stale_rate": no_of_stale/len(self.parents) if self.parents else 0,
+            "forks": len(fork_lengths),
+            "fork_lengths": np.bincount(np.array(list(fork_lengths.values()),dtype=np.int64)).tolist() if fork_lengths else [],
+            "reorgs": len(reorg_depths),
+            "reorg_depths": np.bincount(np.array(reorg_depths,dtype=np.int64)).tolist() if reorg_depths else [],
+        }
+
+    def block_latencies(self):
+        """
+        Function to get the time from the mining of a block until a peer adds it to its blockchain,
+        for every block added by a peer other than its creator
+        Blocks withheld by a selfish miner count from their mining, so their latency includes the withholding
+        """
+        added = self.of_kind(TRACE_BLOCK_ADDED)
+        added = added[added["peer"] != added["aux"]]
+        mined_times = self.mined["time"][np.searchsorted(self.mined["item"],added["item"])]
+        return added["time"] - mined_times
+
+    def block_propagation(self,fraction=0.9):
+        """
+        Function to get, for every mined block, the time from its mining until a fraction of the peers has added it
+        Returns an array in the order of the block ids, with nan for the blocks that never reached the fraction
+        """
+        added = self.of_kind(TRACE_BLOCK_ADDED)
+        added = added[np.lexsort((added["time"],added["item"]))]
+        blocks,first,counts = np.unique(added["item"],return_index=True,return_counts=True)
+        k = max(1,math.ceil(fraction * self.no_of_peers)) # number of peers that must have the block
+        times = np.full(len(self.mined),np.nan)
+        reached = counts >= k
+        positions = np.searchsorted(self.mined["item"],blocks[reached])
+        times[positions] = added["time"][first[reached] + k - 1] - self.mined["time"][positions]
+        return times
+
+    def transaction_latencies(self):
+        """
+        Function to get the time from the creation of a transaction until a peer sees it, for every peer that sees it
+        """
+        created = np.sort(self.of_kind(TRACE_TXN_CREATED),order="item")
+        recieved = self.of_kind(TRACE_TXN_RECIEVED)
+        recieved = recieved[np.isin(recieved["item"],created["item"])]
+        return recieved["time"] - created["time"][np.searchsorted(created["item"],recieved["item"])]
+
+    def summary(self,peer_id=None):
+        """
+        Function to get the results of all the analyses of the trace
+        """
+        summary = {"records": len(self.records),"no_of_peers": self.no_of_peers,"adversary1_id": self.adversary1_id,"adversary2_id": self.adversary2_id}
+        summary.update(self.mpu(peer_id))
+        summary.update(self.forks(peer_id))
+        for name,latencies in (("block_latency",self.block_latencies()),("block_propagation_90",self.block_propagation(0.9)),("transaction_latency",self.transaction_latencies())):
+            latencies = latencies[~np.isnan(latencies)]
+            if len(latencies) == 0:
+                continue
+            summary[name + "_mean"] = float(latencies.mean())
+            for percentile in (50,90,99):
+                summary[f"{name}_p{percentile}"] = float(np.percentile(latencies,percentile))
+        return summary
+
+############################################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse the trace of a blockchain simulation")
+    parser.add_argument("trace",help="file of the trace")
+    parser.add_argument("--peer",type=int,default=None,help="peer whose longest chain is the main chain (the honest peer with the longest chain by default)")
+    args = parser.parse_args()
+
+    for key,value in TraceReader(args.trace).summary(args.peer).items():
+        print(f"{key}: {value}")